@@ -1,13 +1,15 @@
 from bottle import get, post, request, run, response# or route
 from time import time as now
 from hashlib import md5, sha512
+import json
+import zlib
 
 apikey = "#!@$%^dlf$%@!*"
 
-@post('/mw/matches')
-def do_matches():
-    response.content_type = "json"
-
+def check_access_token():
+    '''
+    return the error msg, None if access token is ok
+    '''
     ts = request.query.ts
     at = request.query.at
 
@@ -26,9 +28,49 @@ def do_matches():
         print "auth_expired_access_token"
         return {"msg": "auth_expired_access_token"}
 
-    req_data = request.body.read()
+def read_body():
+    '''
+    read the request body, decompress it if it is gzipped
+    '''
+    body = request.body.read()
+    if request.headers.get('Content-Encoding') == 'gzip':
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    return body
+
+@post('/mw/matches')
+def do_matches():
+    response.content_type = "json"
+
+    error = check_access_token()
+    if error:
+        return error
+
+    req_data = read_body()
     print req_data
     return {"msg":"ok"}
 
-run(host='localhost', port=8088)
+@post('/mw/batch_matches')
+def do_batch_matches():
+    '''
+    for batch mode customers, the body is a json array of push datas
+    '''
+    response.content_type = "json"
+
+    error = check_access_token()
+    if error:
+        return error
 
+    try:
+        datas = json.loads(read_body())
+    except ValueError:
+        datas = None
+    if not isinstance(datas, list):
+        response.status = 400
+        print "bad_batch"
+        return {"msg": "bad_batch"}
+
+    for data in datas:
+        print data
+    return {"msg":"ok", "count": len(datas)}
+
+run(host='localhost', port=8088)
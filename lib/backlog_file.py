@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+backlog export file, written and read frame by frame with bounded memory.
+A file is MAGIC followed by frames, a frame is a FRAME header
+(payload bytes, datas, flags) and a payload of length prefixed datas,
+zlib compressed if flags has COMPRESSED. Datas are the oldest first.
+'''
+
+import zlib
+import struct
+
+from segment import HEADER
+
+MAGIC = "MWPUSH1\n"
+FRAME = struct.Struct(">IIB")
+COMPRESSED = 1
+
+
+class BacklogFileError(Exception):
+    pass
+
+
+def write_header(f):
+    f.write(MAGIC)
+
+
+def read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise BacklogFileError("not a backlog file")
+
+
+def write_frame(f, datas, compress=False):
+    '''
+    write a frame of datas, return the bytes written
+    '''
+    payload = "".join(HEADER.pack(len(data)) + data for data in datas)
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload)
+        flags |= COMPRESSED
+    f.write(FRAME.pack(len(payload), len(datas), flags))
+    f.write(payload)
+    return FRAME.size + len(payload)
+
+
+def read_frames(f):
+    '''
+    yield (datas, offset after the frame) from the current position
+    '''
+    while True:
+        header = f.read(FRAME.size)
+        if not header:
+            return
+        if len(header) < FRAME.size:
+            raise BacklogFileError("truncated frame header")
+        size, count, flags = FRAME.unpack(header)
+        payload = f.read(size)
+        if len(payload) < size:
+            raise BacklogFileError("truncated frame")
+        if flags & COMPRESSED:
+            payload = zlib.decompress(payload)
+        datas = []
+        offset = 0
+        for _ in range(count):
+            length, = HEADER.unpack_from(payload, offset)
+            offset += HEADER.size
+            datas.append(payload[offset:offset + length])
+            offset += length
+        if offset != len(payload):
+            raise BacklogFileError("corrupted frame")
+        yield datas, f.tell()
+
+
+if __name__ == "__main__":
+
+    from cStringIO import StringIO
+
+    f = StringIO()
+    write_header(f)
+    write_frame(f, ["a", "", "c" * 1000])
+    write_frame(f, ["d"], compress=True)
+    size = f.tell()
+    f.seek(0)
+    read_header(f)
+    frames = list(read_frames(f))
+    assert [datas for datas, _ in frames] == [["a", "", "c" * 1000], ["d"]]
+    assert frames[-1][1] == size
+    # resume from the end of the first frame
+    f.seek(frames[0][1])
+    assert [datas for datas, _ in read_frames(f)] == [["d"]]
+    f.truncate(size - 1)
+    f.seek(frames[0][1])
+    try:
+        list(read_frames(f))
+    except BacklogFileError:
+        pass
+    else:
+        assert False
+    print "test_ok"
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+per customer circuit breaker for pushing
+'''
+
+from collections import deque
+from threading import Lock
+from time import time as now
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker(object):
+    '''
+    thread safe circuit breakers keyed by customer id.
+    closed: pushes are allowed. It opens when at least min_requests of the
+    last window results are recorded and their failure rate >= failure_rate.
+    open: pushes are rejected for cooldown seconds, then it is half open.
+    half_open: one trial push is allowed, it is closed if the trial succeeds,
+    otherwise open again.
+    on_change(customer_id, old_state, new_state) is called on transitions.
+    '''
+
+    def __init__(self, window=20, min_requests=5, failure_rate=0.5,
+                 cooldown=30, on_change=None):
+        self._window = window
+        self._min_requests = min_requests
+        self._failure_rate = failure_rate
+        self._cooldown = cooldown
+        self._on_change = on_change
+        # customer_id: [state, results, changed_ts, trial_ts]
+        self._breakers = {}
+        self._lock = Lock()
+
+    def _get(self, customer_id):
+        breaker = self._breakers.get(customer_id)
+        if breaker is None:
+            breaker = self._breakers[customer_id] = [
+                CLOSED, deque(maxlen=self._window), 0, 0]
+        return breaker
+
+    def _change(self, customer_id, breaker, state):
+        old_state, breaker[0], breaker[2] = breaker[0], state, now()
+        breaker[1].clear()
+        if self._on_change:
+            self._on_change(customer_id, old_state, state)
+
+    def allow(self, customer_id):
+        '''
+        return True if pushing to customer is allowed
+        '''
+        with self._lock:
+            breaker = self._get(customer_id)
+            now_ts = now()
+            if breaker[0] == OPEN:
+                if now_ts - breaker[2] < self._cooldown:
+                    return False
+                self._change(customer_id, breaker, HALF_OPEN)
+            if breaker[0] == HALF_OPEN:
+                # a lost trial is given up after cooldown
+                if now_ts - breaker[3] < self._cooldown:
+                    return False
+                breaker[3] = now_ts
+            return True
+
+    def retry_at(self, customer_id):
+        '''
+        return the timestamp when pushing may be allowed again
+        '''
+        with self._lock:
+            breaker = self._breakers.get(customer_id)
+            if breaker is None or breaker[0] == CLOSED:
+                return now()
+            if breaker[0] == OPEN:
+                return breaker[2] + self._cooldown
+            return breaker[3] + self._cooldown
+
+    def success(self, customer_id):
+        with self._lock:
+            breaker = self._get(customer_id)
+            if breaker[0] == HALF_OPEN:
+                self._change(customer_id, breaker, CLOSED)
+            elif breaker[0] == CLOSED:
+                breaker[1].append(True)
+
+    def failure(self, customer_id):
+        with self._lock:
+            breaker = self._get(customer_id)
+            if breaker[0] == HALF_OPEN:
+                self._change(customer_id, breaker, OPEN)
+            elif breaker[0] == CLOSED:
+                results = breaker[1]
+                results.append(False)
+                if len(results) >= self._min_requests and \
+                        results.count(False) >= \
+                        self._failure_rate * len(results):
+                    self._change(customer_id, breaker, OPEN)
+
+    def state(self, customer_id):
+        with self._lock:
+            breaker = self._breakers.get(customer_id)
+            return breaker[0] if breaker else CLOSED
+
+    def stats(self):
+        '''
+        return {"closed": $count, "open": $count, "half_open": $count}
+        '''
+        counts = {CLOSED: 0, OPEN: 0, HALF_OPEN: 0}
+        with self._lock:
+            for breaker in self._breakers.values():
+                counts[breaker[0]] += 1
+        return counts
+
+
+if __name__ == "__main__":
+
+    changes = []
+    breaker = CircuitBreaker(window=4, min_requests=2, failure_rate=0.5,
+                             cooldown=0.1,
+                             on_change=lambda *args: changes.append(args))
+    assert breaker.allow(1)
+    breaker.success(1)
+    breaker.failure(1)
+    assert breaker.state(1) == OPEN
+    assert not breaker.allow(1)
+    assert breaker.stats() == {CLOSED: 0, OPEN: 1, HALF_OPEN: 0}
+
+    import time
+    time.sleep(0.1)
+    # only one trial is allowed when half open
+    assert breaker.allow(1)
+    assert not breaker.allow(1)
+    breaker.failure(1)
+    assert breaker.state(1) == OPEN
+    assert breaker.retry_at(1) > time.time()
+    time.sleep(0.1)
+    assert breaker.allow(1)
+    breaker.success(1)
+    assert breaker.state(1) == CLOSED
+    assert [change[2] for change in changes] == [
+        OPEN, HALF_OPEN, OPEN, HALF_OPEN, CLOSED]
+    print "test_ok"
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+in-process aggregation of the daily push counts.
+Increments are summed per (utc date, field) and flushed together by a
+daemon thread every interval seconds, when max_pending increments are
+pending, and at exit. A crash loses at most interval seconds or
+max_pending increments of counts.
+'''
+
+import time
+import atexit
+import threading
+
+
+class PushCounters(object):
+    '''
+    flush_func: called with {(date, field): count}, date is "yyyymmdd".
+    Counts are kept and flushed again later if it raises.
+    '''
+
+    def __init__(self, flush_func, interval=1.0, max_pending=1000):
+        self._flush_func = flush_func
+        self._interval = interval
+        self._max_pending = max_pending
+        self._counts = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._day = None
+        self._day_end = 0
+        thr = threading.Thread(target=self._run, name="PushCounters")
+        thr.setDaemon(True)
+        thr.start()
+        atexit.register(self.flush)
+
+    def _today(self):
+        now = time.time()
+        if now >= self._day_end:
+            self._day = time.strftime("%Y%m%d", time.gmtime(now))
+            # utc days start at the multiples of 86400
+            self._day_end = (now // 86400 + 1) * 86400
+        return self._day
+
+    def add(self, field, count=1):
+        with self._lock:
+            key = (self._today(), field)
+            self._counts[key] = self._counts.get(key, 0) + count
+            self._pending += 1
+            full = self._pending >= self._max_pending
+        if full:
+            self._wakeup.set()
+
+    def pending(self):
+        return self._pending
+
+    def flush(self):
+        '''
+        flush the pending counts, return False if flush_func failed
+        '''
+        with self._flush_lock:
+            with self._lock:
+                counts, self._counts = self._counts, {}
+                pending, self._pending = self._pending, 0
+            if not counts:
+                return True
+            try:
+                self._flush_func(counts)
+            except Exception:
+                with self._lock:
+                    for key, count in counts.items():
+                        self._counts[key] = self._counts.get(key, 0) + count
+                    self._pending += pending
+                return False
+            return True
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+if __name__ == "__main__":
+
+    flushed = []
+    fail = [True]
+
+    def flush_func(counts):
+        if fail[0]:
+            raise IOError("redis is down")
+        flushed.append(counts)
+
+    counters = PushCounters(flush_func, interval=0.2, max_pending=5)
+    today = time.strftime("%Y%m%d", time.gmtime())
+    counters.add("pushed_cnt", 2)
+    counters.add("required_pushing_cnt")
+    assert not counters.flush()
+    assert counters.pending() == 2
+    fail[0] = False
+    assert counters.flush()
+    assert flushed == [{(today, "pushed_cnt"): 2,
+                        (today, "required_pushing_cnt"): 1}]
+    # flushed by the thread when max_pending increments are pending
+    for _ in range(5):
+        counters.add("pushed_cnt")
+    time.sleep(0.1)
+    assert flushed[-1] == {(today, "pushed_cnt"): 5}
+    # flushed by the thread every interval
+    counters.add("pushed_cnt")
+    time.sleep(0.3)
+    assert flushed[-1] == {(today, "pushed_cnt"): 1}
+    assert counters.pending() == 0
+    print "test_ok"
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+consistent hash ring, customers are assigned to repusher nodes by it.
+Only about 1/n customers move when a node joins or leaves.
+'''
+
+import bisect
+import hashlib
+
+
+def _hash(key):
+    return int(hashlib.md5(str(key)).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    '''
+    nodes: node names
+    replicas: virtual points per node, more replicas spread keys evenly
+    '''
+
+    def __init__(self, nodes=(), replicas=100):
+        self._replicas = replicas
+        self._nodes = ()
+        # (sorted points, node of every point), replaced as a whole
+        self._ring = ((), ())
+        self.set_nodes(nodes)
+
+    def set_nodes(self, nodes):
+        '''
+        rebuild the ring, return True if the nodes changed
+        '''
+        nodes = tuple(sorted(set(nodes)))
+        if nodes == self._nodes:
+            return False
+        ring = sorted((_hash("{}#{}".format(node, i)), node)
+                      for node in nodes for i in range(self._replicas))
+        # readers in other threads see the old ring or the new one
+        self._ring = (tuple(point for point, _ in ring),
+                      tuple(node for _, node in ring))
+        self._nodes = nodes
+        return True
+
+    def nodes(self):
+        return self._nodes
+
+    def get_node(self, key):
+        '''
+        return the node of key, None if no node
+        '''
+        keys, points = self._ring
+        if not keys:
+            return None
+        i = bisect.bisect(keys, _hash(key)) % len(keys)
+        return points[i]
+
+
+if __name__ == "__main__":
+
+    ring = HashRing(["a", "b", "c"])
+    assert ring.get_node("1") == HashRing(["c", "b", "a"]).get_node("1")
+    assert HashRing().get_node("1") is None
+    owners = dict((i, ring.get_node(i)) for i in range(3000))
+    for node in ("a", "b", "c"):
+        assert 700 < owners.values().count(node) < 1300
+    # only the keys of the leaving node move
+    assert ring.set_nodes(["a", "b"])
+    assert not ring.set_nodes(["b", "a"])
+    for i, node in owners.items():
+        if node != "c":
+            assert ring.get_node(i) == node
+        else:
+            assert ring.get_node(i) in ("a", "b")
+    print "test_ok"
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+per customer push latency profiles and the adaptive push timeouts
+'''
+
+import math
+import struct
+from array import array
+from collections import deque
+from threading import Lock
+from time import time as now
+
+
+class LatencyProfile(object):
+    '''
+    ewma and the last window latencies of a customer, in milliseconds
+    '''
+
+    HEADER = struct.Struct("<f")
+
+    def __init__(self, window=100, alpha=0.2):
+        self.alpha = alpha
+        self.ewma = 0.0
+        self.samples = deque(maxlen=window)
+
+    def add(self, latency):
+        '''
+        latency: seconds
+        '''
+        ms = min(int(latency * 1000), 65535)
+        if self.samples:
+            self.ewma += self.alpha * (ms - self.ewma)
+        else:
+            self.ewma = float(ms)
+        self.samples.append(ms)
+
+    def p99(self):
+        '''
+        nearest rank 99th percentile
+        '''
+        samples = sorted(self.samples)
+        return samples[int(math.ceil(0.99 * len(samples))) - 1] \
+            if samples else 0
+
+    def dumps(self):
+        '''
+        compact format: little endian float ewma + uint16 latencies
+        '''
+        return self.HEADER.pack(self.ewma) + \
+            array("H", self.samples).tostring()
+
+    @classmethod
+    def loads(cls, data, window=100, alpha=0.2):
+        profile = cls(window, alpha)
+        profile.ewma, = cls.HEADER.unpack_from(data)
+        samples = array("H")
+        samples.fromstring(data[cls.HEADER.size:])
+        profile.samples.extend(samples)
+        return profile
+
+
+class LatencyTracker(object):
+    '''
+    thread safe latency profiles of customers.
+    timeouts derived from profiles are in [min_timeout, max_timeout],
+    max_timeout is used until min_samples latencies are recorded.
+    Profiles are loaded by load(customer_id) and synced every sync_interval
+    seconds: the latencies recorded since the last sync are merged into the
+    stored profile, which is saved by save(customer_id, data) and used from
+    then on, so processes share their latencies.
+    '''
+
+    def __init__(self, max_timeout, load, save, min_timeout=1, factor=3,
+                 window=100, min_samples=10, sync_interval=30):
+        self._max_timeout = max_timeout
+        self._min_timeout = min_timeout
+        self._factor = factor
+        self._window = window
+        self._min_samples = min_samples
+        self._sync_interval = sync_interval
+        self._load = load
+        self._save = save
+        # customer_id: [profile, synced_ts, latencies not synced]
+        self._profiles = {}
+        self._lock = Lock()
+
+    def _load_profile(self, customer_id):
+        try:
+            data = self._load(customer_id)
+        except Exception:
+            # profiles are best effort
+            data = None
+        return LatencyProfile.loads(data, self._window) if data \
+            else LatencyProfile(self._window)
+
+    def _profile(self, customer_id):
+        with self._lock:
+            entry = self._profiles.get(customer_id)
+        if entry is None:
+            profile = self._load_profile(customer_id)
+            with self._lock:
+                entry = self._profiles.setdefault(customer_id,
+                                                  [profile, now(), []])
+        return entry
+
+    def _sync(self, customer_id, entry, latencies):
+        '''
+        merge latencies into the stored profile and use it
+        '''
+        profile = self._load_profile(customer_id)
+        for latency in latencies:
+            profile.add(latency)
+        try:
+            self._save(customer_id, profile.dumps())
+        except Exception:
+            pass
+        with self._lock:
+            # recorded while syncing, they are merged by the next sync
+            for latency in entry[2]:
+                profile.add(latency)
+            entry[0] = profile
+
+    def _bound(self, seconds):
+        return min(max(seconds, self._min_timeout), self._max_timeout)
+
+    def timeout(self, customer_id):
+        '''
+        return (connect_timeout, read_timeout) of customer
+        '''
+        profile = self._profile(customer_id)[0]
+        with self._lock:
+            if len(profile.samples) < self._min_samples:
+                return (self._max_timeout, self._max_timeout)
+            ewma, p99 = profile.ewma, profile.p99()
+        return (self._bound(ewma * self._factor / 1000.0),
+                self._bound(p99 * self._factor / 1000.0))
+
+    def record(self, customer_id, latency):
+        '''
+        record a push latency in seconds, failed pushes included
+        '''
+        entry = self._profile(customer_id)
+        with self._lock:
+            entry[0].add(latency)
+            entry[2].append(latency)
+            sync = now() - entry[1] >= self._sync_interval
+            if sync:
+                entry[1] = now()
+                latencies, entry[2] = entry[2], []
+        if sync:
+            self._sync(customer_id, entry, latencies)
+
+
+if __name__ == "__main__":
+
+    profile = LatencyProfile(window=4)
+    for latency in (0.1, 0.2, 0.3, 0.4, 0.5):
+        profile.add(latency)
+    assert list(profile.samples) == [200, 300, 400, 500]
+    assert profile.p99() == 500
+    loaded = LatencyProfile.loads(profile.dumps(), window=4)
+    assert list(loaded.samples) == list(profile.samples)
+    assert abs(loaded.ewma - profile.ewma) < 0.01
+
+    store = {}
+    tracker = LatencyTracker(30, store.get, store.__setitem__, min_samples=2,
+                             sync_interval=0)
+    assert tracker.timeout(1) == (30, 30)
+    tracker.record(1, 0.5)
+    tracker.record(1, 0.5)
+    assert tracker.timeout(1) == (1.5, 1.5)
+    # a slow push raises the timeout
+    tracker.record(1, 5)
+    assert tracker.timeout(1)[1] == 15
+    assert LatencyProfile.loads(store[1]).samples[-1] == 5000
+    # latencies of another process are merged when syncing
+    other = LatencyTracker(30, store.get, store.__setitem__, min_samples=2,
+                           sync_interval=0)
+    other.record(1, 0.1)
+    assert len(LatencyProfile.loads(store[1]).samples) == 4
+    tracker.record(1, 0.2)
+    assert list(tracker._profile(1)[0].samples) == [500, 500, 5000, 100, 200]
+    print "test_ok"
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+bounded in-process LRU cache with ttl
+'''
+
+from collections import OrderedDict
+from threading import Lock
+from time import time as now
+
+
+class LRUCache(object):
+    '''
+    thread safe LRU cache, entries expire after ttl seconds.
+    hits and misses are counted by get
+    '''
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = OrderedDict()  # key: (value, expire_ts)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[1] < now():
+                self.misses += 1
+                return default
+            # move to the most recently used end
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expire_ts = now() + (self._ttl if ttl is None else ttl)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expire_ts)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        '''
+        return {"hits": $hits, "misses": $misses, "size": $size}
+        '''
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._data)}
+
+    def __len__(self):
+        return len(self._data)
+
+
+if __name__ == "__main__":
+
+    cache = LRUCache(maxsize=2, ttl=1)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    # "b" is the least recently used
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    cache.set("d", 4, ttl=-1)
+    assert cache.get("d") is None
+    assert cache.stats() == {"hits": 3, "misses": 2, "size": 1}
+    print "test_ok"
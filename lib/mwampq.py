@@ -1,36 +1,242 @@
+import sys
 import time
+import socket
+import threading
+from collections import deque
+from Queue import Queue as ThreadQueue
 from kombu import Connection, Exchange, Queue
+from kombu.serialization import dumps
 
 
+# seconds between two settle passes when the connection is idle
+SETTLE_INTERVAL = 0.05
+# messages smaller than it are published without compression
+COMPRESS_THRESHOLD = 1024
+# seconds waiting for publisher confirms
+CONFIRM_TIMEOUT = 30
+
+
+class _DeferredMessage(object):
+    '''
+    proxy of a kombu message handed to worker threads.
+    ack/requeue/reject are queued and sent on the connection thread later,
+    other attributes are read from the real message.
+    '''
+
+    def __init__(self, message, settled):
+        self._message = message
+        self._settled = settled
+
+    def ack(self):
+        self._settled.put(("ack", self._message))
+
+    def requeue(self):
+        self._settled.put(("requeue", self._message))
+
+    def reject(self):
+        self._settled.put(("reject", self._message))
+
+    def __getattr__(self, attr):
+        return getattr(self._message, attr)
+
+
+class _WorkerPool(object):
+    '''
+    run the poll callback in worker threads.
+    ack_batch > 1: acks are sent with multiple=True for the last contiguous
+    acked delivery tag, when ack_batch acks are pending or the first of them
+    waited ack_interval seconds. Requeue and reject are sent at once.
+    '''
+
+    def __init__(self, cb_func, workers, ack_batch=0, ack_interval=1.0):
+        self._cb_func = cb_func
+        self._workers = workers
+        self._tasks = ThreadQueue()
+        self._settled = ThreadQueue()
+        self._errors = ThreadQueue()
+        self._ack_batch = ack_batch
+        self._ack_interval = ack_interval
+        self._delivered = deque()  # delivery tags not settled, in order
+        self._acked = {}  # delivery_tag: acked message not sent
+        self._rejected = set()  # delivery tags requeued or rejected
+        self._last_acked = None  # the last contiguous acked message
+        self._pending_acks = 0
+        self._pending_since = 0
+
+    def start(self):
+        for i in range(self._workers):
+            thr = threading.Thread(target=self._run,
+                                   name="AmqpWorker-{}".format(i))
+            thr.setDaemon(True)
+            thr.start()
+
+    def put(self, body, message):
+        if self._ack_batch > 1:
+            self._delivered.append(message.delivery_tag)
+        self._tasks.put((body, _DeferredMessage(message, self._settled)))
+
+    def _run(self):
+        while True:
+            body, message = self._tasks.get()
+            try:
+                self._cb_func(body, message)
+            except:
+                self._errors.put(sys.exc_info())
+
+    def settle(self):
+        '''
+        send the deferred acks back, must be called in the connection thread.
+        The first exception raised by callback is raised again here.
+        '''
+        while not self._settled.empty():
+            method, message = self._settled.get()
+            if self._ack_batch <= 1:
+                getattr(message, method)()
+            elif method == "ack":
+                self._acked[message.delivery_tag] = message
+            else:
+                getattr(message, method)()
+                self._rejected.add(message.delivery_tag)
+        if self._ack_batch > 1:
+            self._settle_acks()
+        if not self._errors.empty():
+            self._flush_acks()
+            exc_type, exc_value, exc_tb = self._errors.get()
+            raise exc_type, exc_value, exc_tb
+
+    def _settle_acks(self):
+        while self._delivered:
+            tag = self._delivered[0]
+            if tag in self._acked:
+                if not self._pending_acks:
+                    self._pending_since = time.time()
+                self._last_acked = self._acked.pop(tag)
+                self._pending_acks += 1
+            elif tag in self._rejected:
+                self._rejected.discard(tag)
+            else:
+                break
+            self._delivered.popleft()
+        if self._pending_acks >= self._ack_batch or (self._pending_acks and
+                time.time() - self._pending_since >= self._ack_interval):
+            self._flush_acks()
+
+    def _flush_acks(self):
+        '''
+        ack all messages up to the last contiguous acked one
+        '''
+        if self._pending_acks:
+            self._last_acked.channel.basic_ack(self._last_acked.delivery_tag,
+                                               multiple=True)
+            self._pending_acks = 0
+
 
 class Amqp(object):
 
-    def __init__(self, url, exchange, queue, routing_key):
+    def __init__(self, url, exchange, queue, routing_key, serializer='json',
+                 compress_threshold=COMPRESS_THRESHOLD, confirm=False):
+        '''
+        serializer: kombu serializer of sent messages, 'msgpack' is a compact
+        binary one (msgpack-python required). Consumers decode messages by
+        their content type, whatever serializer is used.
+        compress_threshold: messages of at least the bytes are zlib compressed
+        confirm: wait for the broker confirming published messages
+        '''
 
         self.conn = Connection(url)
         self.exchange = Exchange(exchange, 'direct')
         self.routing_key = routing_key
         self.queue = Queue(queue, self.exchange, self.routing_key)
+        self.serializer = serializer
+        self.compress_threshold = compress_threshold
+        self.confirm = confirm
 
         self.producer = None
         self.consumer = None
+        self._published = 0
+        self._confirmed = 0
 
     def send(self, obj):
+        self.send_many([obj])
+
+    def send_many(self, objs):
+        '''
+        publish objs, confirms of all of them are waited at once
+        if confirm is set
+        '''
         if not self.producer:
             self.producer = self.conn.Producer()
-        self.producer.publish(obj, exchange=self.exchange,
-                              routing_key=self.routing_key,
-                              declare=[self.queue],
-                              serializer='json', compression='zlib')
+            if self.confirm:
+                self._confirm_select()
+        for obj in objs:
+            content_type, content_encoding, body = dumps(
+                obj, serializer=self.serializer)
+            compression = 'zlib' \
+                if len(body) >= self.compress_threshold else None
+            self.producer.publish(body, exchange=self.exchange,
+                                  routing_key=self.routing_key,
+                                  declare=[self.queue],
+                                  content_type=content_type,
+                                  content_encoding=content_encoding,
+                                  compression=compression)
+            self._published += 1
+        if self.confirm:
+            self._wait_confirms()
+
+    def _confirm_select(self):
+        channel = self.producer.channel
+        if not hasattr(channel, 'confirm_select'):
+            # transport without publisher confirms, etc: memory
+            self.confirm = False
+            return
+        channel.confirm_select()
+        channel.events['basic_ack'].add(self._on_confirm)
+
+    def _on_confirm(self, delivery_tag, multiple):
+        # the broker confirms messages in publishing order
+        self._confirmed = max(self._confirmed, delivery_tag)
 
-    def poll(self, cb_func):
+    def _wait_confirms(self):
+        deadline = time.time() + CONFIRM_TIMEOUT
+        while self._confirmed < self._published:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("wait publisher confirms timeout")
+            self.conn.drain_events(timeout=remaining)
+
+    def _consume(self, cb_func, prefetch_count):
         if not self.consumer:
             self.consumer = self.conn.Consumer(self.queue,
                                                callbacks=[cb_func])
-            self.consumer.qos(prefetch_count=1)
+            self.consumer.qos(prefetch_count=prefetch_count)
         self.consumer.consume()
+
+    def poll(self, cb_func, prefetch_count=1, workers=0, ack_batch=0,
+             ack_interval=1.0):
+        '''
+        consume messages, cb_func(body, message) is called for every message.
+        workers is 0: cb_func is called in the connection thread one by one.
+        workers > 0: cb_func is called by workers threads concurrently,
+        at most prefetch_count messages are in flight. message.ack/requeue
+        called by workers are sent back in the connection thread,
+        because kombu channel is not thread safe.
+        ack_batch > 1 with workers: acks are sent in batches of at most
+        ack_batch messages or every ack_interval seconds.
+        '''
+        if workers <= 0:
+            self._consume(cb_func, prefetch_count)
+            while True:
+                self.conn.drain_events()
+
+        pool = _WorkerPool(cb_func, workers, ack_batch, ack_interval)
+        pool.start()
+        self._consume(pool.put, prefetch_count)
         while True:
-            self.conn.drain_events()
+            try:
+                self.conn.drain_events(timeout=SETTLE_INTERVAL)
+            except socket.timeout:
+                pass
+            pool.settle()
 
     def _release(self):
         if self.consumer:
@@ -56,7 +262,63 @@ def process_task(body, message):
     message.ack()
 
 if __name__ == '__main__':
-    with Amqp("amqp://192.168.5.229:5672", "123", "video", "video2") as q:
-        q.send({"fuck":"123"})
-        q.poll(process_task)
+
+    # test for batched acks, settled out of order with a requeue
+    class FakeChannel(object):
+
+        def __init__(self):
+            self.acks = []
+            self.requeued = []
+
+        def basic_ack(self, delivery_tag, multiple=False):
+            self.acks.append((delivery_tag, multiple))
+
+    class FakeMessage(object):
+
+        def __init__(self, channel, delivery_tag):
+            self.channel = channel
+            self.delivery_tag = delivery_tag
+
+        def requeue(self):
+            self.channel.requeued.append(self.delivery_tag)
+
+    channel = FakeChannel()
+    pool = _WorkerPool(None, 0, ack_batch=3, ack_interval=0.2)
+    messages = {}
+    for tag in range(1, 8):
+        messages[tag] = FakeMessage(channel, tag)
+        pool.put(None, messages[tag])
+
+    def settle(method, *tags):
+        for tag in tags:
+            getattr(_DeferredMessage(messages[tag], pool._settled), method)()
+        pool.settle()
+
+    # not acked past the unsettled 1
+    settle("ack", 3, 2)
+    assert channel.acks == []
+    # requeue is sent at once and skipped by the contiguous acks
+    settle("requeue", 4)
+    assert channel.requeued == [4]
+    assert channel.acks == []
+    settle("ack", 1)
+    assert channel.acks == [(3, True)]
+    # not acked past the unsettled 5
+    settle("ack", 6)
+    settle("ack", 5)
+    assert channel.acks == [(3, True)]
+    # 2 pending acks are sent after ack_interval
+    time.sleep(0.3)
+    pool.settle()
+    assert channel.acks == [(3, True), (6, True)]
+    # pending acks are sent before a callback error is raised
+    pool._errors.put((ValueError, ValueError("callback failed"), None))
+    try:
+        settle("ack", 7)
+    except ValueError:
+        pass
+    else:
+        assert False
+    assert channel.acks == [(3, True), (6, True), (7, True)]
+    print "test_ok"
 
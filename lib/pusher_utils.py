@@ -1,28 +1,174 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import json
+import zlib
 from hashlib import md5, sha512
 from time import time as now
+from threading import Lock
+from urlparse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests import RequestException as PushError
 
 
+class SessionPool(object):
+    '''
+    keep-alive requests sessions keyed by customer host, thread safe.
+    max_hosts: the least recently used session is closed when exceeded
+    max_per_host: connections kept alive for one host
+    idle_timeout: sessions unused for idle_timeout seconds are closed
+    '''
+
+    def __init__(self, max_hosts=100, max_per_host=10, idle_timeout=60):
+        self._max_hosts = max_hosts
+        self._max_per_host = max_per_host
+        self._idle_timeout = idle_timeout
+        self._sessions = {}  # host: [session, last_used_ts]
+        self._lock = Lock()
+
+    def get(self, url):
+        '''
+        return the session of url's host
+        '''
+        parts = urlsplit(url)
+        host = "{}://{}".format(parts.scheme, parts.netloc)
+        now_ts = now()
+        with self._lock:
+            entry = self._sessions.get(host)
+            if entry is None:
+                self._evict(now_ts)
+                entry = self._sessions[host] = [self._new_session(), now_ts]
+            entry[1] = now_ts
+            return entry[0]
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self._max_per_host)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _evict(self, now_ts):
+        for host, (session, last_used) in self._sessions.items():
+            if now_ts - last_used > self._idle_timeout:
+                session.close()
+                del self._sessions[host]
+        while len(self._sessions) >= self._max_hosts:
+            host = min(self._sessions, key=lambda h: self._sessions[h][1])
+            self._sessions.pop(host)[0].close()
+
+    def close(self):
+        with self._lock:
+            for session, _ in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+_sessions = SessionPool()
+
+# min body size to be compressed for gzip customers
+GZIP_THRESHOLD = 64 * 1024
+
+
+def configure_sessions(max_hosts=100, max_per_host=10, idle_timeout=60):
+    '''
+    replace the process wide session pool used by push2customer
+    '''
+    global _sessions
+    old, _sessions = _sessions, SessionPool(max_hosts, max_per_host,
+                                            idle_timeout)
+    old.close()
+
+
+def configure_gzip(threshold):
+    global GZIP_THRESHOLD
+    GZIP_THRESHOLD = threshold
+
+
+# a push url is reused until it is valid for less than invalid_sec,
+# so it is valid for invalid_sec + TOKEN_REUSE seconds when generated
+TOKEN_REUSE = 60
+TOKEN_CACHE_SIZE = 10000
+_tokens = {}  # (url, apikey): (ts, push_url)
+
+
 def generate_push_url(url, apikey, invalid_sec):
-    ts = int(now()) + invalid_sec
+    now_ts = int(now())
+    cached = _tokens.get((url, apikey))
+    if cached and cached[0] >= now_ts + invalid_sec:
+        return cached[1]
+    ts = now_ts + invalid_sec + TOKEN_REUSE
     at = md5(sha512("{}{}".format(apikey, ts)).hexdigest()).hexdigest()
-    return "{}?ts={}&at={}".format(url, ts, at)
+    push_url = "{}?ts={}&at={}".format(url, ts, at)
+    if len(_tokens) >= TOKEN_CACHE_SIZE:
+        _tokens.clear()
+    _tokens[(url, apikey)] = (ts, push_url)
+    return push_url
 
 
-def push2customer(url, data, timeout):
+def pack_batch(datas):
+    '''
+    pack push datas into a json array for batch mode customers.
+    string datas must be json texts
+    '''
+    parts = []
+    for data in datas:
+        if isinstance(data, dict):
+            data = json.dumps(data)
+        elif isinstance(data, unicode):
+            data = data.encode("utf-8")
+        parts.append(data)
+    return "[{}]".format(",".join(parts))
+
+
+def data_size(data):
+    if isinstance(data, dict):
+        return len(json.dumps(data))
+    return len(data)
+
+
+def split_batches(datas, max_items, max_bytes):
+    '''
+    split datas into lists of at most max_items datas and max_bytes bytes,
+    a data larger than max_bytes is a batch alone
+    '''
+    batch, size = [], 0
+    for data in datas:
+        length = data_size(data)
+        if batch and (len(batch) >= max_items or size + length > max_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append(data)
+        size += length
+    if batch:
+        yield batch
+
+
+def gzip_compress(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def push2customer(url, data, timeout, compress=False):
+    '''
+    compress: gzip the body larger than GZIP_THRESHOLD bytes,
+    for customers accepting "Content-Encoding: gzip" only
+    '''
     headers = {"Connection": "Keep-Alive", "Accept": "*/*"}
+    session = _sessions.get(url)
     if isinstance(data, dict):
-        r = requests.post(url, json=data, headers=headers, timeout=timeout)
-    else:
-        if isinstance(data, unicode):
-            # support utf8 encoding bytes only
-            data = data.encode("utf-8")
-        r = requests.post(url, data=data, headers=headers, timeout=timeout)
+        data = json.dumps(data)
+        headers["Content-Type"] = "application/json"
+    elif isinstance(data, unicode):
+        # support utf8 encoding bytes only
+        data = data.encode("utf-8")
+    if compress and len(data) >= GZIP_THRESHOLD:
+        data = gzip_compress(data)
+        headers["Content-Encoding"] = "gzip"
+    r = session.post(url, data=data, headers=headers, timeout=timeout)
     if r.status_code != 200:
         try:
             msg = r.json()['msg']
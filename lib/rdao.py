@@ -5,18 +5,262 @@
 redis data access object for pusher module
 '''
 
+import os
+import sys
+import json
+import uuid
+import hashlib
 import redis
+import socket
 import datetime
+import math
 import time
+import threading
 from redis import RedisError as RdaoException
 from redis import ConnectionError, ReadOnlyError
 
-from pusher_utils import generate_push_url, push2customer, PushError
+from pusher_utils import generate_push_url, push2customer, PushError, \
+    pack_batch, split_batches
+from lrucache import LRUCache
+from latency import LatencyTracker
+from segment import write_segment, read_segment, HEADER
+from counters import PushCounters
+from backlog_file import write_header, read_header, write_frame, read_frames
 
 
 DATA_EXPIRE = 8 * 3600 * 24
 RETRY_BACKOFF = 120
 MAX_DELAY = 3600
+# datas moved to tmp key at once by pushall
+DRAIN_CHUNK = 100
+# "$customer_id:0/1" is published when reachable flag is set
+REACHABLE_CHANNEL = "customer_reachable"
+# sorted set of customers having push data, scored by next push timestamp
+SCHEDULE = "push_schedule"
+# newly scheduled customers are published for waking up the repushers
+WAKEUP = "push_wakeup"
+# seconds between polling the wakeup subscription
+WAKEUP_POLL = 0.1
+# set of customers marked by save_push_data for spilling
+SPILLS = "push_spill"
+# "{module}_nodes" sorted set of alive nodes scored by heartbeat timestamp
+NODES = "{}_nodes"
+# owner of the customer being pushed
+CUSTOMER_LOCK = "{}#lock"
+# push counts are rolled up to "{yyyymm}_push_info_month" and PUSH_INFO_TOTAL
+# besides the daily "{yyyymmdd}_push_info"
+PUSH_INFO_TOTAL = "push_info_total"
+
+# customer's push options stored in {id}#infos and their defaults
+# batch_size > 1 is batch mode: datas are pushed as a json array of at most
+# batch_size datas and batch_bytes bytes, mwPusher lingers batch_linger
+# milliseconds for collecting a batch.
+# gzip is 1 if customer accepts gzip compressed body
+# window > 1 keeps at most window pushes (datas or batches) in flight when
+# pushall drains the backlog, they are confirmed in order
+PUSH_OPTIONS = {
+    "batch_size": 1,
+    "batch_bytes": 1024 * 1024,
+    "batch_linger": 0,
+    "gzip": 0,
+    "window": 1,
+}
+
+# KEYS: infos, customers, push_info of day, month and total (optional)
+# ARGV: customer_id, info field/value pairs...
+# customer info is not written when there is no field/value pair
+# required push count is not increased when there is no push_info key
+# return customer's infos
+INGEST_SCRIPT = """
+if #ARGV > 1 then
+    redis.call('HMSET', KEYS[1], unpack(ARGV, 2))
+    redis.call('SADD', KEYS[2], ARGV[1])
+end
+for i = 3, #KEYS do
+    redis.call('HINCRBY', KEYS[i], 'required_pushing_cnt', 1)
+end
+return redis.call('HGETALL', KEYS[1])
+"""
+
+# KEYS: datas, schedule, spills
+# ARGV: data, expire, customer_id, now, wakeup channel, spill threshold
+# customer is scheduled at now and published if it is not scheduled,
+# it is marked in spills if it has more datas than spill threshold (> 0).
+# return the datas length
+SAVE_PUSH_DATA_SCRIPT = """
+local size = redis.call('LPUSH', KEYS[1], ARGV[1])
+if size == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+if not redis.call('ZSCORE', KEYS[2], ARGV[3]) then
+    redis.call('ZADD', KEYS[2], ARGV[4], ARGV[3])
+    redis.call('PUBLISH', ARGV[5], ARGV[3])
+end
+local threshold = tonumber(ARGV[6])
+if threshold > 0 and size > threshold then
+    redis.call('SADD', KEYS[3], ARGV[3])
+end
+return size
+"""
+
+# KEYS: datas, schedule, segments
+# ARGV: customer_id
+# unschedule customer if it has no push data
+UNSCHEDULE_SCRIPT = """
+if redis.call('LLEN', KEYS[1]) == 0 and redis.call('LLEN', KEYS[3]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# KEYS: datas, tmp
+# ARGV: count
+# move at most count datas from the right of datas to tmp,
+# the oldest is still the rightest. return the moved datas
+CLAIM_SCRIPT = """
+local datas = redis.call('LRANGE', KEYS[1], -tonumber(ARGV[1]), -1)
+if #datas > 0 then
+    redis.call('LTRIM', KEYS[1], 0, -#datas - 1)
+    -- unpack fails above about 8000 values
+    for i = 1, #datas, 1000 do
+        redis.call('RPUSH', KEYS[2],
+                   unpack(datas, i, math.min(i + 999, #datas)))
+    end
+end
+return datas
+"""
+
+# KEYS: datas, segments
+# ARGV: count, sha1 of the rightest count datas, segment index entry
+# trim the rightest count datas and append the entry of their segment,
+# unless the datas were changed by a concurrent pushall.
+# return 1 if spilled
+SPILL_SCRIPT = """
+local datas = redis.call('LRANGE', KEYS[1], -tonumber(ARGV[1]), -1)
+if #datas ~= tonumber(ARGV[1]) then
+    return 0
+end
+local parts = {}
+for i, data in ipairs(datas) do
+    parts[i] = #data .. ":" .. data
+end
+if redis.sha1hex(table.concat(parts)) ~= ARGV[2] then
+    return 0
+end
+redis.call('LTRIM', KEYS[1], 0, -#datas - 1)
+redis.call('RPUSH', KEYS[2], ARGV[3])
+return 1
+"""
+
+# append backup to the right of datas then delete backup,
+# set expire if datas not exists. return the restored size
+RESTORE_FUNCTION = """
+local function restore(datas_key, backup_key, expire)
+    local size = redis.call('LLEN', backup_key)
+    if size == 0 then
+        return 0
+    end
+    if redis.call('EXISTS', datas_key) == 0 then
+        redis.call('RENAME', backup_key, datas_key)
+        redis.call('EXPIRE', datas_key, expire)
+        return size
+    end
+    for start = 0, size - 1, 1000 do
+        local datas = redis.call('LRANGE', backup_key, start, start + 999)
+        redis.call('RPUSH', datas_key, unpack(datas))
+    end
+    redis.call('DEL', backup_key)
+    return size
+end
+"""
+
+# KEYS: datas, backup
+# ARGV: expire
+RESTORE_SCRIPT = RESTORE_FUNCTION + """
+return restore(KEYS[1], KEYS[2], ARGV[1])
+"""
+
+# KEYS: datas, tmp, infos, retries, segments, schedule
+# ARGV: customer_id, now, expire
+# the state of a customer before pushall, after restoring tmp to datas:
+# {0} and unscheduled if it has no push data,
+# {1, next_push_ts, datas length} and scheduled at next_push_ts if it is
+# backing off,
+# {2, datas length, infos, retry info, segments} otherwise
+SNAPSHOT_SCRIPT = RESTORE_FUNCTION + """
+restore(KEYS[1], KEYS[2], ARGV[3])
+local size = redis.call('LLEN', KEYS[1])
+local segments = redis.call('LRANGE', KEYS[5], 0, -1)
+if size == 0 and #segments == 0 then
+    redis.call('ZREM', KEYS[6], ARGV[1])
+    return {0}
+end
+local next_push_ts = tonumber(redis.call('HGET', KEYS[4], 'next_push_ts') or 0)
+if tonumber(ARGV[2]) <= next_push_ts then
+    redis.call('ZADD', KEYS[6], next_push_ts, ARGV[1])
+    return {1, next_push_ts, size}
+end
+return {2, size, redis.call('HGETALL', KEYS[3]),
+        redis.call('HGETALL', KEYS[4]), segments}
+"""
+
+# KEYS: datas, staging
+# ARGV: count, expire
+# move at most count datas from the left of staging to the right of datas,
+# rename staging to datas if datas not exists.
+# return the moved size, -1 if renamed
+MERGE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if redis.call('EXISTS', KEYS[2]) == 0 then
+        return 0
+    end
+    redis.call('RENAME', KEYS[2], KEYS[1])
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return -1
+end
+local datas = redis.call('LRANGE', KEYS[2], 0, ARGV[1] - 1)
+for i = 1, #datas, 1000 do
+    redis.call('RPUSH', KEYS[1], unpack(datas, i, math.min(i + 999, #datas)))
+end
+if #datas > 0 then
+    redis.call('LTRIM', KEYS[2], #datas, -1)
+end
+return #datas
+"""
+
+# KEYS: lock
+# ARGV: owner
+# delete the lock if it is still held by owner
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS: segments, datas
+# ARGV: removed segments, new head segment entry or "", removed datas
+# remove the oldest segments and datas at once
+REMOVE_BACKLOG_SCRIPT = """
+redis.call('LTRIM', KEYS[1], ARGV[1], -1)
+if ARGV[2] ~= "" then
+    redis.call('LSET', KEYS[1], 0, ARGV[2])
+end
+if tonumber(ARGV[3]) > 0 then
+    redis.call('LTRIM', KEYS[2], 0, -1 - ARGV[3])
+end
+"""
+
+# KEYS: lock
+# ARGV: owner, expire
+# refresh the expire of the lock if it is still held by owner
+REFRESH_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
 
 
 def retry(delay=3):
@@ -37,13 +281,112 @@ def retry(delay=3):
 
 class Rdao(object):
 
-    def __init__(self, redis_url="redis://127.0.0.1/0"):
+    def __init__(self, redis_url="redis://127.0.0.1/0", info_cache_size=0,
+                 info_cache_ttl=300, breaker=None, drain_chunk=DRAIN_CHUNK,
+                 on_segment_error=None):
+        '''
+        info_cache_size > 0 caches the customer infos written by ingest and
+        their push options, unchanged infos are written again only after
+        info_cache_ttl seconds
+        breaker: a breaker.CircuitBreaker guarding pushall
+        drain_chunk: datas moved to tmp key at once by pushall
+        on_segment_error: called with (customer_id, segment index entry) by
+        pushall when the oldest segment of customer can't be read here
+        '''
         self._redis_url = redis_url
         self._redis = redis.from_url(redis_url, retry_on_timeout=True)
         self._datas = "{}#datas"
         self._infos = "{}#infos"
         self._retries = "{}#retries"
+        self._latencies = "{}#latency"
+        # index of the spilled segments, the oldest at the left
+        self._segments = "{}#segments"
+        self._ingest = self._redis.register_script(INGEST_SCRIPT)
+        self._save_push_data = self._redis.register_script(
+            SAVE_PUSH_DATA_SCRIPT)
+        self._claim = self._redis.register_script(CLAIM_SCRIPT)
+        self._restore = self._redis.register_script(RESTORE_SCRIPT)
+        self._snapshot = self._redis.register_script(SNAPSHOT_SCRIPT)
+        self._unschedule = self._redis.register_script(UNSCHEDULE_SCRIPT)
+        self._unlock = self._redis.register_script(UNLOCK_SCRIPT)
+        self._refresh_lock = self._redis.register_script(REFRESH_LOCK_SCRIPT)
+        self._remove_backlog = self._redis.register_script(
+            REMOVE_BACKLOG_SCRIPT)
+        self._merge = self._redis.register_script(MERGE_SCRIPT)
+        self._spill_script = self._redis.register_script(SPILL_SCRIPT)
+        self._wakeup = None
+        self._drain_chunk_size = drain_chunk
+        self._info_cache = LRUCache(info_cache_size, info_cache_ttl) \
+            if info_cache_size > 0 else None
+        self._reachable_cache = None
+        self._reachable_ttl = 0
+        self._breaker = breaker
+        self._latency = None
+        self._segment_dir = None
+        self._spill_threshold = 0
+        self._segment_size = 0
+        self._spill_mark = 0
+        self._on_segment_error = on_segment_error
+        self._counters = None
+
+    @staticmethod
+    def push_options(customer_info):
+        '''
+        return the push options of customer_info with defaults
+        '''
+        return {name: int(customer_info.get(name, default))
+                for name, default in PUSH_OPTIONS.items()}
+    @staticmethod
+    def _push_info_key(date=None):
+        '''
+        date format: "yyyymmdd", today if date is None
+        '''
+        if date is None:
+            date = datetime.datetime.utcnow().strftime("%Y%m%d")
+        return "{}_push_info".format(date)
+
+    @staticmethod
+    def _push_info_keys(date=None):
+        '''
+        return the day, month and total push info keys of date
+        '''
+        day_key = Rdao._push_info_key(date)
+        return (day_key, "{}_push_info_month".format(day_key[:6]),
+                PUSH_INFO_TOTAL)
+
+    def _incr_push_info(self, pipe, field, count=1):
+        '''
+        add increasing today's push counts to pipe,
+        or to the local counters if they are aggregated
+        '''
+        if self._counters is not None:
+            self._counters.add(field, count)
+            return
+        for key in self._push_info_keys():
+            pipe.hincrby(key, field, count)
 
+    def aggregate_counters(self, interval=1.0, max_pending=1000):
+        '''
+        aggregate the push counts in process, they are written to redis
+        every interval seconds, when max_pending increments are pending
+        and at exit
+        '''
+        self._counters = PushCounters(self._flush_push_info, interval,
+                                      max_pending)
+
+    def flush_counters(self):
+        '''
+        return False if the aggregated push counts failed to be written
+        '''
+        return self._counters is None or self._counters.flush()
+
+    @retry()
+    def _flush_push_info(self, counts):
+        pipe = self._redis.pipeline()
+        for (date, field), count in counts.items():
+            for key in self._push_info_keys(date):
+                pipe.hincrby(key, field, count)
+        pipe.execute()
 
     def kingship(self, module, expire_time=10):
         '''
@@ -58,6 +401,55 @@ class Rdao(object):
         '''
         return bool(self._redis.set(module + "_master", "", ex=expire_time, xx=True))
 
+    @retry()
+    def heartbeat(self, module, node_id, expire_time=10):
+        '''
+        register node_id as an alive node of module, remove the nodes
+        not heartbeating in expire_time seconds.
+        return the alive nodes
+        '''
+        key = NODES.format(module)
+        # redis time, nodes' clocks may differ
+        now = self._redis.time()[0]
+        pipe = self._redis.pipeline()
+        pipe.execute_command("ZADD", key, now, node_id)
+        pipe.zremrangebyscore(key, "-inf", now - expire_time)
+        pipe.zrange(key, 0, -1)
+        return pipe.execute()[-1]
+
+    @retry()
+    def leave(self, module, node_id):
+        '''
+        unregister node_id, its customers are taken by the others
+        '''
+        self._redis.zrem(NODES.format(module), node_id)
+
+    @retry()
+    def lock_customer(self, customer_id, owner, expire_time):
+        '''
+        return True if owner locks the customer for pushing
+        '''
+        return bool(self._redis.set(CUSTOMER_LOCK.format(customer_id), owner,
+                                    ex=expire_time, nx=True))
+
+    @retry()
+    def unlock_customer(self, customer_id, owner):
+        '''
+        return True if the lock is held by owner and released
+        '''
+        return bool(self._unlock(keys=[CUSTOMER_LOCK.format(customer_id)],
+                                 args=[owner], client=self._redis))
+
+    @retry()
+    def refresh_lock(self, customer_id, owner, expire_time):
+        '''
+        return True if the lock is held by owner and expires in expire_time
+        seconds again
+        '''
+        return bool(self._refresh_lock(
+            keys=[CUSTOMER_LOCK.format(customer_id)],
+            args=[owner, expire_time], client=self._redis))
+
     @retry()
     def save_push_data(self, customer_id, data):
         '''
@@ -65,13 +457,75 @@ class Rdao(object):
         increase required push count
         '''
         key = self._datas.format(customer_id)
-        if not self._redis.exists(key):
-            self._redis.lpush(key, data)
-            self._redis.expire(key, DATA_EXPIRE)
-        else:
-            self._redis.lpush(key, data)
+        self._save_push_data(keys=[key, SCHEDULE, SPILLS],
+                             args=[data, DATA_EXPIRE, customer_id,
+                                   int(time.time()), WAKEUP,
+                                   self._spill_mark],
+                             client=self._redis)
         #self.incr_required_push()
 
+    @retry()
+    def ingest(self, customer_id, info):
+        '''
+        bookkeeping of a new message in one round trip:
+        set customer info, increase required push count.
+        Customer info is skipped if it is the same as the cached one.
+        No round trip at all if the info and the reachable flag are cached
+        and the push counts are aggregated, the cached push options are used
+        then, they are read again after info_cache_ttl seconds.
+        return (reachable, push_options)
+        '''
+        info_items = tuple(sorted(info.items()))
+        entry = self._info_cache.get(str(customer_id)) \
+            if self._info_cache is not None else None
+        cached = entry is not None and entry[0] == info_items
+        if cached and self._counters is not None and \
+                self._reachable_cache is not None:
+            reachable = self._reachable_cache.get(str(customer_id))
+            if reachable is not None:
+                self._counters.add("required_pushing_cnt")
+                return reachable, entry[1]
+        args = [customer_id]
+        if not cached:
+            for field, value in info_items:
+                args.extend((field, value))
+        keys = [self._infos.format(customer_id), "customers"]
+        if self._counters is None:
+            keys.extend(self._push_info_keys())
+        infos = self._ingest(keys=keys, args=args, client=self._redis)
+        # counted once even if the call is retried
+        if self._counters is not None:
+            self._counters.add("required_pushing_cnt")
+        infos = dict(zip(infos[::2], infos[1::2]))
+        reachable = bool(int(infos.get("reachable", 1)))
+        options = self.push_options(infos)
+        if not cached and self._info_cache is not None:
+            self._info_cache.set(str(customer_id), (info_items, options))
+        if self._reachable_cache is not None:
+            self._reachable_cache.set(str(customer_id), reachable,
+                                      self._reachable_ttl)
+        return reachable, options
+
+    def info_cache_stats(self):
+        '''
+        return {"hits": $hits, "misses": $misses, "size": $size}
+        None if customer info cache is disabled
+        '''
+        if self._info_cache is None:
+            return None
+        return self._info_cache.stats()
+
+    @retry()
+    def finish_push(self, customer_id, data, pushed):
+        '''
+        bookkeeping after pushing a message in one round trip:
+        increase pushed count if pushed, otherwise save the push data
+        '''
+        if pushed:
+            self.incr_pushed()
+        else:
+            self.save_push_data(customer_id, data)
+
     @retry()
     def push_data_ttl(self, customer_id):
         '''
@@ -81,124 +535,686 @@ class Rdao(object):
         key = self._datas.format(customer_id)
         return self._redis.ttl(key)
 
-    @retry()
-    def dump_push_data(self, customer_id, dump_file):
+    def export_push_data(self, customer_id, export_file, chunk=1000,
+                         compress=False, progress=None):
         '''
-        Dump the customer push data to a file before deleting it for free memory
-        Notes: It will block other commands long time when the key size is too large
-        return None if customer has no any data to push, otherwise return dump_file
+        Export the customer push data to a file chunk by chunk, the oldest
+        first, before deleting it for free memory. The spilled segments are
+        exported before the datas in redis, the datas claimed by an
+        interrupted pushall are restored first. The datas are not removed.
+        The exported size is saved in export_file.progress after every chunk,
+        an interrupted export is resumed by calling it again.
+        The customer should be locked by lock_customer meanwhile, and until
+        an interrupted export is resumed, a pushall or spill changes the
+        oldest datas and the exported size no longer skips the right ones.
+        progress: called with (exported, total) after every chunk
+        return the exported size
         '''
         key = self._datas.format(customer_id)
-        dumps = self._redis.dump(key)
-        if dumps:
-            with open(dump_file, "wb") as fp:
-                fp.write(dumps)
-            return dump_file
-        else:
-            return None
+        state_file = export_file + ".progress"
+        exported, offset = 0, 0
+        if os.path.exists(state_file):
+            with open(state_file) as fp:
+                state = json.load(fp)
+            exported, offset = state['exported'], state['offset']
+        self._restore_backup_data(key, key + "_tmp")
+        segments = [json.loads(entry) for entry in self._redis.lrange(
+            self._segments.format(customer_id), 0, -1)]
+        size = self._redis.llen(key)
+        total = sum(entry['count'] for entry in segments) + size
+        with open(export_file, "r+b" if offset else "wb") as fp:
+            if offset:
+                fp.seek(offset)
+                fp.truncate()
+            else:
+                write_header(fp)
+            for datas in self._backlog_chunks(key, segments, size, exported,
+                                              chunk):
+                write_frame(fp, datas, compress)
+                fp.flush()
+                os.fsync(fp.fileno())
+                exported += len(datas)
+                with open(state_file + ".tmp", "w") as state_fp:
+                    json.dump({"exported": exported, "offset": fp.tell()},
+                              state_fp)
+                os.rename(state_file + ".tmp", state_file)
+                if progress:
+                    progress(exported, total)
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        return exported
+
+    def _backlog_chunks(self, key, segments, size, skip, chunk):
+        '''
+        yield at most chunk datas at once, the oldest first, of segments
+        and then of the rightest size datas of key, after skipping the
+        oldest skip datas
+        '''
+        for entry in segments:
+            if skip >= entry['count']:
+                skip -= entry['count']
+                continue
+            offset = entry['offset']
+            if skip:
+                _, offset = read_segment(entry['path'], offset, skip)
+            count, skip = entry['count'] - skip, 0
+            while count > 0:
+                datas, offset = read_segment(entry['path'], offset,
+                                             min(chunk, count))
+                if not datas:
+                    break
+                count -= len(datas)
+                yield datas
+        while skip < size:
+            # datas are pushed at the left, indexes from the right are stable
+            datas = self._redis.lrange(key, -skip - min(chunk, size - skip),
+                                       -skip - 1)
+            if not datas:
+                break
+            datas.reverse()
+            skip += len(datas)
+            yield datas
+
+    def import_push_data(self, customer_id, import_file, progress=None):
+        '''
+        It is usually invoked by tools for restoring exported push data.
+        Datas are imported to a staging key frame by frame with the file
+        offset, then appended to the right of push data as the oldest ones.
+        An interrupted import is resumed from the saved offset by calling it
+        again. The customer should be locked by lock_customer meanwhile.
+        progress: called with (imported bytes, file bytes) after every frame
+        return the imported size
+        '''
+        key = self._datas.format(customer_id)
+        staging_key = key + "_import"
+        offset_key = staging_key + "_offset"
+        offset = int(self._redis.get(offset_key) or 0)
+        total = os.path.getsize(import_file)
+        imported = 0
+        with open(import_file, "rb") as fp:
+            if offset:
+                fp.seek(offset)
+            else:
+                read_header(fp)
+            for datas, offset in read_frames(fp):
+                if datas:
+                    # the oldest data is the rightest
+                    pipe = self._redis.pipeline()
+                    pipe.lpush(staging_key, *datas)
+                    pipe.expire(staging_key, DATA_EXPIRE)
+                    pipe.set(offset_key, offset, ex=DATA_EXPIRE)
+                    pipe.execute()
+                imported += len(datas)
+                if progress:
+                    progress(offset, total)
+        while self._merge(keys=[key, staging_key],
+                          args=[self._drain_chunk_size, DATA_EXPIRE],
+                          client=self._redis) > 0:
+            pass
+        self._redis.delete(offset_key)
+        self.schedule(customer_id)
+        return imported
 
     @retry()
-    def restore_push_data(self, customer_id, dump_file):
+    def schedule(self, customer_id, next_push_ts=None):
         '''
-        It is usually invoked by tools for restoring push data.
-        Exception "redis.exceptions.ResponseError: Target key name is busy." will be
-        raised if push_data key exists.
-        You can catch the exception in a loop, retry until push_data key not exists
+        schedule customer to be pushed at next_push_ts, now if it is None
         '''
-        key = self._datas.format(customer_id)
-        with open(dump_file, "rb") as fp:
-            self._redis.restore(key, 0, fp.read())
+        if next_push_ts is None:
+            next_push_ts = int(time.time())
+        self._redis.execute_command("ZADD", SCHEDULE, next_push_ts,
+                                    customer_id)
+
+    @retry()
+    def get_due_customers(self, now_ts=None, limit=None):
+        '''
+        return customers scheduled not later than now_ts,
+        at most limit earliest ones if limit is not None
+        '''
+        if now_ts is None:
+            now_ts = int(time.time())
+        if limit is None:
+            return self._redis.zrangebyscore(SCHEDULE, "-inf", now_ts)
+        return self._redis.zrangebyscore(SCHEDULE, "-inf", now_ts,
+                                         start=0, num=limit)
+
+    @retry()
+    def next_due_ts(self):
+        '''
+        return the earliest scheduled timestamp, None if nothing scheduled
+        '''
+        first = self._redis.zrange(SCHEDULE, 0, 0, withscores=True)
+        return first[0][1] if first else None
+
+    @retry()
+    def is_due(self, customer_id, now_ts=None):
+        '''
+        return True if the customer is scheduled and due
+        '''
+        if now_ts is None:
+            now_ts = int(time.time())
+        score = self._redis.zscore(SCHEDULE, customer_id)
+        return score is not None and score <= now_ts
+
+    @retry()
+    def wait_for_schedule(self, timeout):
+        '''
+        block until a customer is newly scheduled or timeout seconds passed
+        return True if waked up by a scheduled customer
+        '''
+        if self._wakeup is None:
+            # customers published before subscribed are due already
+            self._wakeup = self._redis.pubsub(ignore_subscribe_messages=True)
+            self._wakeup.subscribe(WAKEUP)
+        deadline = time.time() + timeout
+        # get_message of redis 2.10.1 does not block
+        woke = self._wakeup.get_message() is not None
+        while not woke and time.time() < deadline:
+            time.sleep(min(WAKEUP_POLL, max(deadline - time.time(), 0)))
+            woke = self._wakeup.get_message() is not None
+        # due customers are read from the schedule
+        while woke and self._wakeup.get_message() is not None:
+            pass
+        return woke
 
     @retry()
-    def pushall(self, customer_id, timeout):
+    def rebuild_schedule(self):
+        '''
+        schedule all customers having push data, who are not scheduled.
+        It is for the customers saved before scheduling is supported.
+        return the scheduled size
+        '''
+        customers = list(self.get_all_customers())
+        pipe = self._redis.pipeline()
+        for customer_id in customers:
+            key = self._datas.format(customer_id)
+            pipe.exists(key)
+            pipe.exists(key + "_tmp")
+            pipe.zscore(SCHEDULE, customer_id)
+            pipe.hget(self._retries.format(customer_id), "next_push_ts")
+        results = pipe.execute()
+        scheduled = 0
+        for i, customer_id in enumerate(customers):
+            has_data, has_tmp, score, next_push_ts = results[i * 4: i * 4 + 4]
+            if (has_data or has_tmp) and score is None:
+                pipe.execute_command("ZADD", SCHEDULE,
+                                     int(next_push_ts or 0), customer_id)
+                scheduled += 1
+        pipe.execute()
+        return scheduled
+
+    @retry()
+    def pushall(self, customer_id, timeout, max_items=0, max_seconds=0,
+                keepalive=None):
         '''
         Push customer data until exceptions raised or all data be pushed.
         Set unreachable if pushed failed.
-        Set reachable if all data be pushed.
-        Increase pushed count when pushed successfully one by one.
+        Set reachable if all data (or a slice of them) be pushed.
+        max_items, max_seconds: stop after a slice of pushed items or seconds,
+        chunk by chunk, the customer keeps scheduled for the rest datas.
+        0 is no limit.
+        Increase pushed count when pushed successfully chunk by chunk.
         Update retry_info.
-        Using rpoplpush method and tmp key to storage pushed failed data
+        Datas are moved to tmp key chunk by chunk before being pushed
         for ensuring data is not lost.
+        The customer's state is read by one script call, which returns early
+        for the customers having no data or backing off.
+        Spilled datas are pushed first, unless the oldest segment can't be
+        read here, then it is retried after RETRY_BACKOFF.
+        keepalive: called before every chunk and after every spilled segment,
+        pushall stops without touching tmp key if it returns False, e.g. the
+        customer lock is lost.
         return the push data size really
         '''
         key = self._datas.format(customer_id)
         tmp_key = key + "_tmp"
-        self._restore_backup_data(key, tmp_key)
-        customer_info = self.get_customer_info(customer_id)
-        retry_info = self.get_retry_info(customer_id)
+        index_key = self._segments.format(customer_id)
+        snapshot = self._snapshot(
+            keys=[key, tmp_key, self._infos.format(customer_id),
+                  self._retries.format(customer_id), index_key, SCHEDULE],
+            args=[customer_id, int(time.time()), DATA_EXPIRE],
+            client=self._redis)
+        if snapshot[0] == 0:
+            return None  # None is no data to push
+        if snapshot[0] == 1:
+            # the backlog of an unreachable customer grows meanwhile
+            if self._segment_dir and snapshot[2] > self._spill_threshold:
+                self._spill(customer_id, key, snapshot[2], keepalive)
+            return 0 # 0 is not need to push as retry backoff
+        data_size, customer_info, retry_info, segments = snapshot[1:]
+        customer_info = dict(zip(customer_info[::2], customer_info[1::2]))
+        retry_info = dict(zip(retry_info[::2], map(int, retry_info[1::2])))
+        for field in ("latest_push_ts", "next_push_ts", "push_retries"):
+            retry_info.setdefault(field, 0)
         apikey, url = customer_info['apikey'], customer_info['push_url']
+        options = self.push_options(customer_info)
+        segments = self._prune_segments(
+            index_key, [json.loads(entry) for entry in segments])
 
-        to_push_size = self.push_data_size(customer_id)
-        if to_push_size <= 0:
-            return None  # None is no data to push
+        if self._segment_dir and data_size > self._spill_threshold:
+            self._spill(customer_id, key, data_size, keepalive)
 
-        if int(time.time()) <= retry_info['next_push_ts']:
-            return 0 # 0 is not need to push as retry backoff
+        # the datas in redis are pushed ahead of a segment not readable here
+        unreadable = bool(segments) and \
+            not self._segment_readable(segments[0])
+        if unreadable and self._on_segment_error is not None:
+            self._on_segment_error(customer_id, segments[0])
+
+        if self._breaker is not None and not self._breaker.allow(customer_id):
+            self.schedule(customer_id,
+                          int(math.ceil(self._breaker.retry_at(customer_id))))
+            return 0 # 0 is not need to push as circuit breaker is open
 
         retry_info['push_retries'] += 1
         retry_info['latest_push_ts'] = int(time.time())
 
         really_push_size = 0
+        deadline = time.time() + max_seconds if max_seconds else None
+        lost = False
 
         try:
             while 1:
-                data = self._redis.rpoplpush(key, tmp_key)
-                if not data:
+                if keepalive is not None and not keepalive():
+                    lost = True
+                    break
+                # spilled datas are older than the datas in redis
+                pushed = (not unreadable and
+                          self._drain_segment(customer_id, index_key, url,
+                                              apikey, timeout, options)) or \
+                    self._drain_chunk(customer_id, key, tmp_key, url,
+                                      apikey, timeout, options)
+                if not pushed:
+                    break
+                really_push_size += pushed
+                if max_items and really_push_size >= max_items:
+                    break
+                if deadline is not None and time.time() >= deadline:
                     break
-                else:
-                    # set url invalid time larger than timeout
-                    push_url = generate_push_url(url, apikey, timeout + 10)
-                    push2customer(push_url, data, timeout)
-                    self._redis.lrem(tmp_key, data)
-                    self.incr_pushed()
-                    really_push_size += 1
         except PushError:
+            if self._breaker is not None:
+                self._breaker.failure(customer_id)
             self.set_unreachable(customer_id)
             retry_info['next_push_ts'] = int(time.time()) + min(
                 RETRY_BACKOFF * pow(2, retry_info['push_retries'] - 1), MAX_DELAY)
+            self.schedule(customer_id, retry_info['next_push_ts'])
             raise
         except:
             raise
         else:
+            if self._breaker is not None:
+                self._breaker.success(customer_id)
             self._redis.expire(key, DATA_EXPIRE)
             self.set_reachable(customer_id)
+            if unreadable and not pushed:
+                # retry the segment later instead of every loop
+                self.schedule(customer_id, int(time.time()) + RETRY_BACKOFF)
             retry_info = {"latest_push_ts": 0,
                     "next_push_ts": 0,
                     "push_retries": 0}
         finally:
             self.set_retry_info(customer_id, retry_info)
-            self._restore_backup_data(key, tmp_key)
+            # tmp key may be being pushed by the new lock owner
+            if not lost:
+                self._restore_backup_data(key, tmp_key)
+            self._unschedule(keys=[key, SCHEDULE, index_key],
+                             args=[customer_id], client=self._redis)
 
         return really_push_size
 
+    def _push(self, customer_id, url, apikey, data, timeout, options):
+        '''
+        push a data to customer, timeout is the max timeout
+        if latency is tracked
+        '''
+        # set url invalid time larger than timeout
+        push_url = generate_push_url(url, apikey, timeout + 10)
+        if self._latency is None:
+            push2customer(push_url, data, timeout, compress=options['gzip'])
+            return
+        start = time.time()
+        try:
+            push2customer(push_url, data, self._latency.timeout(customer_id),
+                          compress=options['gzip'])
+        finally:
+            self._latency.record(customer_id, time.time() - start)
+
+    def _drain_chunk(self, customer_id, key, tmp_key, url, apikey, timeout,
+                     options):
+        '''
+        move at most drain_chunk datas to tmp_key atomically and push them
+        one by one, or in batches for batch mode customer, with at most
+        window pushes in flight.
+        Pushed datas are removed from tmp_key and counted in one round trip
+        when the chunk is done or failed, so at most a chunk of datas may be
+        pushed again after a crash.
+        return the pushed size, 0 if no data
+        '''
+        chunk = max(self._drain_chunk_size, options['batch_size'])
+        datas = self._claim(keys=[key, tmp_key], args=[chunk],
+                            client=self._redis)
+        # the oldest data first
+        datas.reverse()
+        pushed, exc_info = self._push_datas(customer_id, url, apikey, datas,
+                                            timeout, options)
+        if pushed:
+            # the oldest datas are at the right of tmp_key
+            pipe = self._redis.pipeline()
+            pipe.ltrim(tmp_key, 0, -1 - pushed)
+            self._incr_push_info(pipe, "pushed_cnt", pushed)
+            pipe.execute()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return pushed
+
+    def _push_datas(self, customer_id, url, apikey, datas, timeout, options):
+        '''
+        push datas oldest first, one by one or in batches for batch mode
+        customer, with at most window pushes in flight.
+        return (pushed, exc_info), pushed is the number of datas pushed in
+        order before the first failure, exc_info is the failure or None
+        '''
+        if options['batch_size'] > 1:
+            batches = list(split_batches(datas, options['batch_size'],
+                                         options['batch_bytes']))
+            payloads = [pack_batch(batch) for batch in batches]
+            sizes = [len(batch) for batch in batches]
+        else:
+            payloads, sizes = datas, [1] * len(datas)
+        if options['window'] > 1:
+            confirmed, exc_info = self._push_window(
+                customer_id, url, apikey, payloads, timeout, options)
+        else:
+            confirmed, exc_info = 0, None
+            for payload in payloads:
+                try:
+                    self._push(customer_id, url, apikey, payload, timeout,
+                               options)
+                except:
+                    exc_info = sys.exc_info()
+                    break
+                confirmed += 1
+        return sum(sizes[:confirmed]), exc_info
+
+    def enable_spill(self, segment_dir, threshold, segment_size=10000):
+        '''
+        pushall and spill move the oldest datas of a customer having more
+        than threshold datas in redis to segment files in segment_dir, until
+        threshold / 2 datas are left. A segment has at most segment_size
+        datas, redis keeps their index only.
+        '''
+        self._segment_dir = segment_dir
+        self._spill_threshold = threshold
+        self._segment_size = segment_size
+        self.mark_spill(threshold)
+
+    def mark_spill(self, threshold):
+        '''
+        save_push_data marks the customers having more than threshold datas
+        for spilling, they are read by get_spill_customers
+        '''
+        self._spill_mark = threshold
+
     @retry()
-    def _restore_backup_data(self, key, backup_key):
-        for backup in self._redis.lrange(backup_key, 0, -1):
-            if not self._redis.exists(key):
-                self._redis.rpush(key, backup)
-                # Should set expire time if key not exsits
-                self._redis.expire(key, DATA_EXPIRE)
+    def get_spill_customers(self):
+        return self._redis.smembers(SPILLS)
+
+    @retry()
+    def spill(self, customer_id, keepalive=None):
+        '''
+        unmark the customer and spill it if it still has more than threshold
+        datas, return the spilled size.
+        keepalive: called after every segment, stop if it returns False
+        '''
+        self._redis.srem(SPILLS, customer_id)
+        key = self._datas.format(customer_id)
+        size = self._redis.llen(key)
+        if not self._segment_dir or size <= self._spill_threshold:
+            return 0
+        return self._spill(customer_id, key, size, keepalive)
+
+    def _spill(self, customer_id, key, size, keepalive=None):
+        '''
+        spill the oldest datas of key whose length is size,
+        stop if keepalive returns False after a segment.
+        return the spilled size
+        '''
+        index_key = self._segments.format(customer_id)
+        keep = self._spill_threshold // 2
+        spilled = 0
+        while size - spilled > keep:
+            # new datas are pushed at the left, the right ones are stable
+            count = min(self._segment_size, size - spilled - keep)
+            datas = self._redis.lrange(key, -count, -1)
+            if not datas:
+                break
+            digest = hashlib.sha1("".join(
+                "{}:{}".format(len(data), data) for data in datas)).hexdigest()
+            datas.reverse()
+            path = os.path.join(self._segment_dir, str(customer_id),
+                                "{}-{}.seg".format(int(time.time()),
+                                                   uuid.uuid4().hex))
+            write_segment(path, datas)
+            entry = {"host": socket.gethostname(), "path": path, "offset": 0,
+                     "count": len(datas), "ts": int(time.time())}
+            if not self._spill_script(keys=[key, index_key],
+                                      args=[len(datas), digest,
+                                            json.dumps(entry)],
+                                      client=self._redis):
+                # claimed by a pushall meanwhile, spill it next time
+                self._remove_segment(path)
+                break
+            spilled += len(datas)
+            if keepalive is not None and not keepalive():
+                break
+        return spilled
+
+    @staticmethod
+    def _segment_readable(entry):
+        '''
+        segment is readable on its host or on a shared storage
+        '''
+        return os.path.exists(entry['path'])
+
+    def _prune_segments(self, index_key, segments):
+        '''
+        remove the expired segments at the head of the index, even the ones
+        not readable here, return the rest
+        '''
+        while segments and segments[0]['ts'] + DATA_EXPIRE <= time.time():
+            self._redis.lpop(index_key)
+            self._remove_segment(segments.pop(0)['path'])
+        return segments
+
+    def _drain_segment(self, customer_id, index_key, url, apikey, timeout,
+                       options):
+        '''
+        push at most drain_chunk datas of the oldest segment, its offset in
+        the index is moved over the pushed datas and counted in one round
+        trip. Drained and expired segments are removed.
+        return the pushed size, 0 if no segment
+        '''
+        chunk = max(self._drain_chunk_size, options['batch_size'])
+        while True:
+            head = self._redis.lindex(index_key, 0)
+            if head is None:
+                return 0
+            entry = json.loads(head)
+            datas = []
+            # datas in redis expire after DATA_EXPIRE, so do the spilled
+            if entry['ts'] + DATA_EXPIRE > time.time():
+                datas, _ = read_segment(entry['path'], entry['offset'], chunk)
+            if datas:
+                break
+            self._redis.lpop(index_key)
+            self._remove_segment(entry['path'])
+        pushed, exc_info = self._push_datas(customer_id, url, apikey, datas,
+                                            timeout, options)
+        if pushed:
+            entry['offset'] += sum(HEADER.size + len(data)
+                                   for data in datas[:pushed])
+            entry['count'] -= pushed
+            pipe = self._redis.pipeline()
+            if entry['count'] > 0:
+                pipe.lset(index_key, 0, json.dumps(entry))
             else:
-                self._redis.rpush(key, backup)
-        # delete backup_key
-        self._redis.delete(backup_key)
+                pipe.lpop(index_key)
+            self._incr_push_info(pipe, "pushed_cnt", pushed)
+            pipe.execute()
+            if entry['count'] <= 0:
+                self._remove_segment(entry['path'])
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return pushed
+
+    @staticmethod
+    def _remove_segment(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _push_window(self, customer_id, url, apikey, payloads, timeout,
+                     options):
+        '''
+        push payloads in threads, a payload is not started until the
+        payloads window places before it are confirmed. No payload is started
+        after a failure.
+        return (confirmed, exc_info), confirmed is the number of payloads
+        pushed in order before the first failed one, exc_info is the failure
+        of it or None
+        '''
+        window = options['window']
+        results = [None] * len(payloads)  # True or exc_info
+        state = {"next": 0, "confirmed": 0, "failed": False}
+        cond = threading.Condition()
+
+        def worker():
+            while True:
+                with cond:
+                    while not state["failed"] and \
+                            state["confirmed"] + window <= state["next"] < len(payloads):
+                        cond.wait()
+                    if state["failed"] or state["next"] >= len(payloads):
+                        return
+                    i = state["next"]
+                    state["next"] += 1
+                try:
+                    self._push(customer_id, url, apikey, payloads[i], timeout,
+                               options)
+                    result = True
+                except:
+                    result = sys.exc_info()
+                with cond:
+                    results[i] = result
+                    state["failed"] = state["failed"] or result is not True
+                    while state["confirmed"] < len(payloads) and \
+                            results[state["confirmed"]] is True:
+                        state["confirmed"] += 1
+                    cond.notify_all()
+
+        workers = [threading.Thread(target=worker)
+                   for _ in range(min(window, len(payloads)))]
+        for thr in workers:
+            thr.start()
+        for thr in workers:
+            thr.join()
+        confirmed = state["confirmed"]
+        if confirmed < len(payloads):
+            return confirmed, results[confirmed]
+        return confirmed, None
 
     @retry()
-    def set_reachable(self, customer_id):
+    def _restore_backup_data(self, key, backup_key):
+        '''
+        move all backup datas back to the right of key atomically
+        '''
+        return self._restore(keys=[key, backup_key], args=[DATA_EXPIRE],
+                             client=self._redis)
+
+    def _set_reachable_flag(self, customer_id, flag):
+        '''
+        set reachable flag and notify the watchers
+        '''
         key = self._infos.format(customer_id)
-        self._redis.hset(key, "reachable", 1)
+        pipe = self._redis.pipeline()
+        pipe.hset(key, "reachable", flag)
+        pipe.publish(REACHABLE_CHANNEL, "{}:{}".format(customer_id, flag))
+        pipe.execute()
+
+    @retry()
+    def set_reachable(self, customer_id):
+        self._set_reachable_flag(customer_id, 1)
 
     @retry()
     def set_unreachable(self, customer_id):
-        key = self._infos.format(customer_id)
-        self._redis.hset(key, "reachable", 0)
+        self._set_reachable_flag(customer_id, 0)
 
     @retry()
     def reachable(self, customer_id):
+        if self._reachable_cache is not None:
+            cached = self._reachable_cache.get(str(customer_id))
+            if cached is not None:
+                return cached
         key = self._infos.format(customer_id)
         if not self._redis.hexists(key, "reachable"):
-            return True
-        return bool(int(self._redis.hget(key, "reachable")))
+            flag = True
+        else:
+            flag = bool(int(self._redis.hget(key, "reachable")))
+        if self._reachable_cache is not None:
+            self._reachable_cache.set(str(customer_id), flag,
+                                      self._reachable_ttl)
+        return flag
+
+    def watch_reachable(self, ttl=60, fallback_ttl=5, maxsize=100000):
+        '''
+        cache reachable flags in process. A daemon thread subscribes
+        REACHABLE_CHANNEL and updates the cache when flags are set.
+        Cached flags live ttl seconds while subscribed, fallback_ttl seconds
+        when the subscription is dropped.
+        '''
+        self._reachable_ttl = fallback_ttl
+        self._reachable_cache = LRUCache(maxsize, fallback_ttl)
+        thr = threading.Thread(target=self._watch_reachable,
+                               args=(ttl, fallback_ttl),
+                               name="ReachableWatcher")
+        thr.setDaemon(True)
+        thr.start()
+
+    def _watch_reachable(self, ttl, fallback_ttl):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(REACHABLE_CHANNEL)
+                # flags may be changed before subscribed
+                self._reachable_cache.clear()
+                self._reachable_ttl = ttl
+                for message in pubsub.listen():
+                    customer_id, flag = message['data'].rsplit(":", 1)
+                    self._reachable_cache.set(customer_id, flag == "1", ttl)
+            except RdaoException:
+                pass
+            self._reachable_ttl = fallback_ttl
+            self._reachable_cache.clear()
+            time.sleep(1)
+
+    def track_latency(self, max_timeout, **settings):
+        '''
+        track customers' push latencies, pushall uses the timeouts derived
+        from them. Profiles are shared with other processes by redis.
+        settings: see latency.LatencyTracker
+        return the tracker
+        '''
+        self._latency = LatencyTracker(max_timeout, self.get_latency_profile,
+                                       self.set_latency_profile, **settings)
+        return self._latency
+
+    # profiles are best effort and read on the push path, not retried
+    def get_latency_profile(self, customer_id):
+        return self._redis.get(self._latencies.format(customer_id))
+
+    def set_latency_profile(self, customer_id, data):
+        self._redis.setex(self._latencies.format(customer_id), data,
+                          DATA_EXPIRE)
 
     @retry()
     def get_push_data(self, customer_id, size=1):
@@ -221,6 +1237,39 @@ class Rdao(object):
         key = self._datas.format(customer_id)
         return self._redis.ltrim(key, 0, -1 - size)
 
+    @retry()
+    def remove_backlog(self, customer_id, size):
+        '''
+        remove the oldest size datas exported by export_push_data, the
+        spilled ones first, at once. The customer should be locked meanwhile.
+        '''
+        index_key = self._segments.format(customer_id)
+        removed, head = [], ""
+        for entry in self._redis.lrange(index_key, 0, -1):
+            if size <= 0:
+                break
+            entry = json.loads(entry)
+            if entry['count'] > size:
+                _, entry['offset'] = read_segment(entry['path'],
+                                                  entry['offset'], size)
+                entry['count'] -= size
+                head, size = json.dumps(entry), 0
+                break
+            removed.append(entry['path'])
+            size -= entry['count']
+        self._remove_backlog(
+            keys=[index_key, self._datas.format(customer_id)],
+            args=[len(removed), head, size], client=self._redis)
+        for path in removed:
+            self._remove_segment(path)
+
+    @retry()
+    def unschedule(self, customer_id):
+        '''
+        remove customer from the schedule until it is scheduled again
+        '''
+        self._redis.zrem(SCHEDULE, customer_id)
+
     @retry()
     def push_data_size(self, customer_id):
         key = self._datas.format(customer_id)
@@ -240,6 +1289,8 @@ class Rdao(object):
         key = self._infos.format(customer_id)
         self._redis.hmset(key, info)
         self._redis.sadd("customers", customer_id)
+        if self._info_cache is not None:
+            self._info_cache.pop(str(customer_id))
 
     @retry()
     def get_customer_info(self, customer_id):
@@ -257,34 +1308,32 @@ class Rdao(object):
         self._redis.sadd("customers", customer_id)
 
     @retry()
-    def incr_pushed(self):
-        key = "{}_push_info".format(
-            datetime.datetime.utcnow().strftime("%Y%m%d"))
-        self._redis.hincrby(key, "pushed_cnt")
+    def incr_pushed(self, count=1):
+        pipe = self._redis.pipeline()
+        self._incr_push_info(pipe, "pushed_cnt", count)
+        # nothing is sent if counts are aggregated
+        pipe.execute()
 
     @retry()
     def incr_required_push(self):
-        key = "{}_push_info".format(
-            datetime.datetime.utcnow().strftime("%Y%m%d"))
-        self._redis.hincrby(key, "required_pushing_cnt")
+        pipe = self._redis.pipeline()
+        self._incr_push_info(pipe, "required_pushing_cnt")
+        # nothing is sent if counts are aggregated
+        pipe.execute()
 
     @retry()
     def get_pushed_cnt(self):
         '''
         return today's pushed count
         '''
-        key = "{}_push_info".format(
-            datetime.datetime.utcnow().strftime("%Y%m%d"))
-        return int(self._redis.hget(key, "pushed_cnt"))
+        return int(self._redis.hget(self._push_info_key(), "pushed_cnt"))
 
     @retry()
     def get_required_push_cnt(self):
         '''
         return today's required_push count
         '''
-        key = "{}_push_info".format(
-            datetime.datetime.utcnow().strftime("%Y%m%d"))
-        return int(self._redis.hget(key, "required_pushing_cnt"))
+        return int(self._redis.hget(self._push_info_key(), "required_pushing_cnt"))
 
     @retry()
     def get_push_info(self, date=None):
@@ -292,13 +1341,7 @@ class Rdao(object):
         date format: "yyyymmdd"
         return (required_push_cnt, pushed_cnt, pushed_rate)
         '''
-        if date is None:
-            key = "{}_push_info".format(
-                datetime.datetime.utcnow().strftime("%Y%m%d"))
-        else:
-            key = "{}_push_info".format(date)
-
-        info = self._redis.hgetall(key)
+        info = self._redis.hgetall(self._push_info_key(date))
         if info:
             total, pushed = int(info.get('required_pushing_cnt', 0)), \
                 int(info.get('pushed_cnt', 0))
@@ -312,29 +1355,75 @@ class Rdao(object):
         count up push info from start to end
         Count up all info if start_date is None
         end_date is today if end_date is None
+        Whole months are read from the monthly rollups, all the infos are
+        read in one round trip.
         '''
-        keys = self._redis.keys("????????_push_info")
-        keys = [key[:8] for key in keys]
-
         if start_date is None:
-            pass
-        elif end_date is None:
-            keys = filter(lambda a: a >= start_date, keys)
+            keys = [PUSH_INFO_TOTAL]
         else:
-            keys = filter(lambda a: end_date >= a >= start_date, keys)
+            if end_date is None:
+                end_date = datetime.datetime.utcnow().strftime("%Y%m%d")
+            keys = self._range_push_info_keys(start_date, end_date)
 
+        pipe = self._redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
         totals = 0
         pusheds = 0
-        for key in keys:
-            (total, pushed, _) = self.get_push_info(key)
-            totals += total
-            pusheds += pushed
+        for info in pipe.execute():
+            totals += int(info.get('required_pushing_cnt', 0))
+            pusheds += int(info.get('pushed_cnt', 0))
 
         if totals > 0:
             return (totals, pusheds, pusheds / float(totals))
         else:
             return (0, 0, 0.0)
 
+    def _range_push_info_keys(self, start_date, end_date):
+        '''
+        return the month keys of whole months and the day keys of the other
+        days from start_date to end_date
+        '''
+        day = datetime.datetime.strptime(start_date, "%Y%m%d").date()
+        end = datetime.datetime.strptime(end_date, "%Y%m%d").date()
+        one_day = datetime.timedelta(days=1)
+        keys = []
+        while day <= end:
+            next_month = (day.replace(day=28) + datetime.timedelta(days=4)) \
+                .replace(day=1)
+            if day.day == 1 and next_month - one_day <= end:
+                keys.append(self._push_info_keys(day.strftime("%Y%m%d"))[1])
+                day = next_month
+            else:
+                keys.append(self._push_info_key(day.strftime("%Y%m%d")))
+                day += one_day
+        return keys
+
+    @retry()
+    def rebuild_push_info_rollups(self):
+        '''
+        rebuild the monthly and total push infos from the daily ones by SCAN.
+        It is for the infos counted before rollups are supported, counts
+        increased while rebuilding may be lost.
+        return the number of daily infos
+        '''
+        rollups = {}
+        days = 0
+        for key in self._redis.scan_iter("????????_push_info", count=1000):
+            info = self._redis.hgetall(key)
+            days += 1
+            for rollup in self._push_info_keys(key[:8])[1:]:
+                counts = rollups.setdefault(rollup, {})
+                for field, value in info.items():
+                    counts[field] = counts.get(field, 0) + int(value)
+        pipe = self._redis.pipeline()
+        for key, counts in rollups.items():
+            pipe.delete(key)
+            if counts:
+                pipe.hmset(key, counts)
+        pipe.execute()
+        return days
+
     @retry()
     def get_all_customers(self):
         return self._redis.smembers("customers")
@@ -378,6 +1467,7 @@ class Rdao(object):
         '''
         del self._redis
         self._redis = redis.from_url(self._redis_url)
+        self._wakeup = None
 
 
 if __name__ == "__main__":
@@ -472,7 +1562,7 @@ if __name__ == "__main__":
         ]
     })
 
-    assert rdao.dump_push_data(cus_id, "/tmp/1.dump") is None
+    assert rdao.export_push_data(cus_id, "/tmp/1.dump") == 0
 
     rdao.save_push_data(cus_id, push_data)
     rdao.incr_required_push()
@@ -486,7 +1576,8 @@ if __name__ == "__main__":
     try:
         print "======== before push"
         print rdao.get_retry_info(cus_id)
-        assert "/tmp/1.dump" == rdao.dump_push_data(cus_id, "/tmp/1.dump")
+        assert 2 == rdao.export_push_data(cus_id, "/tmp/1.dump", chunk=1)
+        assert not os.path.exists("/tmp/1.dump.progress")
         assert 0 == rdao.get_retries(cus_id)
         rdao.pushall(cus_id, 10)
         print "======== after push"
@@ -498,11 +1589,6 @@ if __name__ == "__main__":
         assert rdao.push_data_size(cus_id) == 2
         assert rdao.get_push_data(cus_id, 2) == [push_data1, push_data]
 
-        try:
-            rdao.restore_push_data(cus_id, "/tmp/1.dump")
-        except RdaoException as err:
-            assert "Target key name is busy." == str(err)
-
         rdao.remove_push_data(cus_id, 1)
         assert rdao.push_data_size(cus_id) == 1
         assert rdao.get_push_data(cus_id) == [push_data1]
@@ -514,7 +1600,8 @@ if __name__ == "__main__":
         assert not rdao.reachable(cus_id)
         assert (2, 0, 0.0) == rdao.get_push_info()
 
-        rdao.restore_push_data(cus_id, "/tmp/1.dump")
+        assert 2 == rdao.import_push_data(cus_id, "/tmp/1.dump")
+        assert rdao.get_push_data(cus_id, 2) == [push_data1, push_data]
 
     else:
         print rdao.get_retry_info(cus_id)
@@ -526,9 +1613,261 @@ if __name__ == "__main__":
         assert rdao.get_required_push_cnt() == 2
         assert (2, 2, 1.0) == rdao.get_push_info()
         assert (2, 2, 1.0) == rdao.count_up_push_info()
+        today = datetime.datetime.utcnow().strftime("%Y%m%d")
+        assert (2, 2, 1.0) == rdao.count_up_push_info(today, today)
 
-        rdao.restore_push_data(cus_id, "/tmp/1.dump")
+        assert 2 == rdao.import_push_data(cus_id, "/tmp/1.dump")
         assert rdao.get_push_data(cus_id, 2) == [push_data1, push_data]
+        # imported datas are the oldest
+        rdao.save_push_data(cus_id, "new")
+        assert 2 == rdao.import_push_data(cus_id, "/tmp/1.dump")
+        assert rdao.get_push_data(cus_id, 5) == \
+            ["new", push_data1, push_data, push_data1, push_data]
+
+    # test for push info rollups
+    rdao._redis.flushdb()
+    for date in ("20160131", "20160201", "20160229", "20160301"):
+        rdao._redis.hincrby(rdao._push_info_key(date), "required_pushing_cnt", 2)
+        rdao._redis.hincrby(rdao._push_info_key(date), "pushed_cnt", 1)
+    assert 4 == rdao.rebuild_push_info_rollups()
+    assert rdao._range_push_info_keys("20160131", "20160301") == [
+        "20160131_push_info", "201602_push_info_month", "20160301_push_info"]
+    assert (6, 3, 0.5) == rdao.count_up_push_info("20160131", "20160229")
+    assert (2, 1, 0.5) == rdao.count_up_push_info("20160201", "20160228")
+    rdao.incr_required_push()
+    assert (9, 4) == rdao.count_up_push_info()[:2]
+    # aggregated counts are written when flushed
+    rdao.aggregate_counters(interval=60)
+    rdao.incr_required_push()
+    rdao.incr_pushed(3)
+    assert (9, 4) == rdao.count_up_push_info()[:2]
+    assert rdao.flush_counters()
+    assert (10, 7) == rdao.count_up_push_info()[:2]
+    rdao._counters = None
+
+    # test for ingest and finish_push
+    rdao._redis.flushdb()
+    ingest_info = {"push_url": cus_info["push_url"], "apikey": cus_info["apikey"]}
+    assert rdao.ingest(cus_id, ingest_info) == (True, PUSH_OPTIONS)
+    rdao.set_unreachable(cus_id)
+    assert not rdao.ingest(cus_id, ingest_info)[0]
+    rdao.finish_push(cus_id, push_data, False)
+    rdao.finish_push(cus_id, push_data1, True)
+    assert rdao.get_push_data(cus_id) == [push_data]
+    assert rdao.push_data_ttl(cus_id) > 0
+    assert (2, 1, 0.5) == rdao.get_push_info()
+
+    # test for crash mid-drain
+    rdao._redis.flushdb()
+    key = rdao._datas.format(cus_id)
+    tmp_key = key + "_tmp"
+    for i in range(5):
+        rdao.save_push_data(cus_id, str(i))
+    # crashed after claiming 3 datas and confirming the oldest one
+    assert rdao._claim(keys=[key, tmp_key], args=[3],
+                       client=rdao._redis) == ["2", "1", "0"]
+    rdao._redis.ltrim(tmp_key, 0, -2)
+    rdao.save_push_data(cus_id, "5")
+    assert 2 == rdao._restore_backup_data(key, tmp_key)
+    assert rdao.get_push_data(cus_id, 5) == ["5", "4", "3", "2", "1"]
+    assert not rdao._redis.exists(tmp_key)
+    # crashed after claiming all datas
+    rdao._claim(keys=[key, tmp_key], args=[10], client=rdao._redis)
+    assert not rdao._redis.exists(key)
+    assert 5 == rdao._restore_backup_data(key, tmp_key)
+    assert rdao.get_push_data(cus_id, 5) == ["5", "4", "3", "2", "1"]
+    assert rdao.push_data_ttl(cus_id) > 0
+    assert 0 == rdao._restore_backup_data(key, tmp_key)
+    # chunks over the lua unpack limit of batch mode customers
+    big_key = rdao._datas.format(2)
+    rdao._redis.lpush(big_key, *map(str, range(9000)))
+    datas = rdao._claim(keys=[big_key, big_key + "_tmp"], args=[8500],
+                        client=rdao._redis)
+    assert datas == map(str, reversed(range(8500)))
+    assert rdao._redis.lrange(big_key + "_tmp", 0, -1) == datas
+    rdao._redis.delete(big_key, big_key + "_tmp")
+
+    # a failure in the window keeps the unconfirmed datas in tmp
+    rdao._redis.flushdb()
+    for i in range(5):
+        rdao.save_push_data(cus_id, str(i))
+
+    def push_but_1(customer_id, url, apikey, data, timeout, options):
+        if data == "1":
+            raise PushError("refused")
+    rdao._push = push_but_1
+    try:
+        rdao._drain_chunk(cus_id, key, tmp_key, "", "", 10,
+                          dict(PUSH_OPTIONS, window=3))
+    except PushError:
+        pass
+    else:
+        assert False
+    del rdao._push
+    assert rdao._redis.lrange(tmp_key, 0, -1) == ["4", "3", "2", "1"]
+    assert rdao._redis.hget(rdao._push_info_key(), "pushed_cnt") == "1"
+    rdao.save_push_data(cus_id, "5")
+    assert 4 == rdao._restore_backup_data(key, tmp_key)
+    assert rdao.get_push_data(cus_id, 5) == ["5", "4", "3", "2", "1"]
+
+    # test for schedule
+    assert rdao.get_due_customers() == [str(cus_id)]
+    assert rdao.get_due_customers(limit=0) == []
+    assert rdao.is_due(cus_id)
+    rdao.schedule(cus_id, int(time.time()) + 60)
+    assert rdao.get_due_customers() == []
+    assert not rdao.is_due(cus_id)
+    assert not rdao.wait_for_schedule(1)
+    rdao.save_push_data(2, push_data)
+    assert rdao.wait_for_schedule(1)
+    assert rdao.get_due_customers() == ["2"]
+    rdao._redis.delete(rdao._datas.format(2))
+    rdao._redis.zrem(SCHEDULE, 2)
+    rdao._redis.zrem(SCHEDULE, cus_id)
+    rdao._add_customer(cus_id)
+    assert 1 == rdao.rebuild_schedule()
+    assert rdao.get_due_customers() == [str(cus_id)]
+
+    # test for pushall snapshot
+    next_push_ts = int(time.time()) + 60
+    rdao.set_retry_info(cus_id, {"latest_push_ts": 0, "push_retries": 1,
+                                 "next_push_ts": next_push_ts})
+    rdao._claim(keys=[key, tmp_key], args=[2], client=rdao._redis)
+    assert 0 == rdao.pushall(cus_id, 10)
+    # backing off customer is rescheduled, tmp is restored anyway
+    assert rdao._redis.zscore(SCHEDULE, cus_id) == next_push_ts
+    assert rdao.push_data_size(cus_id) == 5
+    rdao._redis.delete(key)
+    assert rdao.pushall(cus_id, 10) is None
+    assert not rdao._redis.exists(SCHEDULE)
+
+    # test for spill
+    import shutil
+    import tempfile
+    rdao._redis.flushdb()
+    segment_dir = tempfile.mkdtemp()
+    rdao.enable_spill(segment_dir, 4, 2)
+    for i in range(7):
+        rdao.save_push_data(cus_id, str(i))
+    key = rdao._datas.format(cus_id)
+    index_key = rdao._segments.format(cus_id)
+    assert 5 == rdao._spill(cus_id, key, 7)
+    assert rdao.get_push_data(cus_id, 2) == ["6", "5"]
+    assert [json.loads(e)['count'] for e in
+            rdao._redis.lrange(index_key, 0, -1)] == [2, 2, 1]
+    pushed_datas = []
+    rdao._push = lambda customer_id, url, apikey, data, timeout, options: \
+        pushed_datas.append(data)
+    options = dict(PUSH_OPTIONS, window=2)
+    assert 2 == rdao._drain_segment(cus_id, index_key, "", "", 10, options)
+    assert 2 == rdao._redis.llen(index_key)
+    while rdao._drain_segment(cus_id, index_key, "", "", 10, options):
+        pass
+    assert sorted(pushed_datas) == ["0", "1", "2", "3", "4"]
+    assert not rdao._redis.exists(index_key)
+    assert os.listdir(os.path.join(segment_dir, str(cus_id))) == []
+    # expired and unreadable segments do not block the datas in redis
+    errors = []
+    rdao._on_segment_error = lambda customer_id, entry: \
+        errors.append(entry['host'])
+    rdao.set_customer_info(cus_id, cus_info)
+    for ts in (0, int(time.time())):
+        rdao._redis.rpush(index_key, json.dumps(
+            {"host": "other", "path": "/nonexistent.seg", "offset": 0,
+             "count": 1, "ts": ts}))
+    rdao.save_push_data(cus_id, "7")
+    assert 3 == rdao.pushall(cus_id, 10)
+    assert pushed_datas[-3:] == ["5", "6", "7"]
+    assert errors == ["other"]
+    assert 1 == rdao._redis.llen(index_key)
+    assert rdao._redis.zscore(SCHEDULE, cus_id) > time.time()
+    rdao._on_segment_error = None
+    rdao._redis.delete(index_key)
+    # customers are marked by save_push_data and spilled by spill
+    for i in range(5):
+        rdao.save_push_data(cus_id, str(i))
+    assert rdao.get_spill_customers() == set([str(cus_id)])
+    assert 3 == rdao.spill(cus_id)
+    assert rdao.get_spill_customers() == set()
+    assert rdao.get_push_data(cus_id, 2) == ["4", "3"]
+    # a spill racing with pushall is given up
+    rdao._redis.rpush(key, "x")
+    real_lrange = rdao._redis.lrange
+    rdao._redis.lrange = lambda *args: real_lrange(*args)[:-1] + ["y"]
+    assert 0 == rdao._spill(cus_id, key, 3)
+    del rdao._redis.lrange
+    assert rdao._redis.llen(index_key) == 2
+    # a backing off customer is spilled too
+    for i in range(3):
+        rdao.save_push_data(cus_id, str(i))
+    rdao.set_retry_info(cus_id, {"latest_push_ts": 0, "push_retries": 1,
+                                 "next_push_ts": int(time.time()) + 60})
+    assert 0 == rdao.pushall(cus_id, 10)
+    assert rdao.push_data_size(cus_id) == 2
+    # the segments and the claimed datas are exported before the rest
+    rdao._claim(keys=[key, key + "_tmp"], args=[1], client=rdao._redis)
+    export_file = os.path.join(segment_dir, "backlog.dump")
+    assert 9 == rdao.export_push_data(cus_id, export_file, chunk=1)
+    with open(export_file, "rb") as fp:
+        read_header(fp)
+        assert [data for datas, _ in read_frames(fp) for data in datas] == \
+            ["0", "1", "2", "x", "3", "4", "0", "1", "2"]
+    rdao.remove_backlog(cus_id, 8)
+    assert not rdao._redis.exists(index_key)
+    assert rdao.get_push_data(cus_id, 2) == ["2"]
+    # pushall stops without restoring tmp when the lock is lost
+    rdao.set_retry_info(cus_id, {"latest_push_ts": 0, "push_retries": 0,
+                                 "next_push_ts": 0})
+
+    def lost():
+        # tmp claimed by the new lock owner
+        rdao._redis.rpush(key + "_tmp", "t")
+        return False
+    assert 0 == rdao.pushall(cus_id, 10, keepalive=lost)
+    assert rdao._redis.lrange(key + "_tmp", 0, -1) == ["t"]
+    assert rdao.get_push_data(cus_id, 2) == ["2"]
+    rdao._redis.delete(key + "_tmp")
+    shutil.rmtree(segment_dir)
+    del rdao._push
+
+    # test for nodes and customer lock
+    assert rdao.heartbeat("test_module", "node1") == ["node1"]
+    assert rdao.heartbeat("test_module", "node2") == ["node1", "node2"]
+    rdao.leave("test_module", "node1")
+    assert rdao.heartbeat("test_module", "node2") == ["node2"]
+    assert rdao.lock_customer(cus_id, "node1", 10)
+    assert not rdao.lock_customer(cus_id, "node2", 10)
+    assert not rdao.unlock_customer(cus_id, "node2")
+    assert rdao.unlock_customer(cus_id, "node1")
+    assert rdao.lock_customer(cus_id, "node2", 10)
+    assert not rdao.refresh_lock(cus_id, "node1", 20)
+    assert rdao.refresh_lock(cus_id, "node2", 20)
+    assert rdao._redis.ttl(CUSTOMER_LOCK.format(cus_id)) > 10
+
+    # test for reachable cache
+    # the flag is flushed by the tests above
+    rdao.set_unreachable(cus_id)
+    watcher = Rdao()
+    watcher.watch_reachable()
+    time.sleep(0.5)
+    assert not watcher.reachable(cus_id)
+    rdao.set_reachable(cus_id)
+    time.sleep(0.5)
+    assert watcher._reachable_cache.get(str(cus_id)) is True
+    assert watcher.reachable(cus_id)
+
+    # test for ingest without round trip
+    watcher = Rdao(info_cache_size=10)
+    watcher.watch_reachable()
+    watcher.aggregate_counters(interval=60)
+    time.sleep(0.5)
+    assert watcher.ingest(cus_id, ingest_info) == (True, PUSH_OPTIONS)
+    del watcher._ingest
+    assert watcher.ingest(cus_id, ingest_info) == (True, PUSH_OPTIONS)
+    assert watcher._counters.pending() == 2
+    rdao.set_unreachable(cus_id)
+    time.sleep(0.5)
+    assert watcher.ingest(cus_id, ingest_info) == (False, PUSH_OPTIONS)
 
     print "test_ok"
 
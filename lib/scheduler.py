@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+continuous push scheduler for mwRepusher.
+Workers take the next customer from a FIFO queue as soon as they are free,
+a customer is in the queue (or being pushed) only once. A worker puts its
+customer back to the tail if it still needs pushing, so a long backlog
+pushed slice by slice does not keep other customers waiting.
+Workers are threads, they are greenlets after gevent.monkey.patch_all().
+'''
+
+import sys
+import threading
+from Queue import Queue
+
+
+class PushScheduler(object):
+    '''
+    push_func: called with customer_id in the workers
+    workers: number of the workers
+    callback: called with (customer_id, result) after pushed
+    exc_callback: called with (customer_id, exc_info) if push_func raised
+    requeue: called with (customer_id, result) after pushed, the customer
+    is put back to the tail of the queue if it returns True
+    '''
+
+    def __init__(self, push_func, workers, callback=None, exc_callback=None,
+                 requeue=None):
+        self._push_func = push_func
+        self._callback = callback
+        self._exc_callback = exc_callback
+        self._requeue = requeue
+        self._queue = Queue()
+        self._pending = set()  # queued or being pushed customers
+        self._lock = threading.Lock()
+        self._workers = []
+        for _ in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.setDaemon(True)
+            self._workers.append(worker)
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, customer_id):
+        '''
+        queue a customer, return False if it is queued or being pushed
+        '''
+        customer_id = str(customer_id)
+        with self._lock:
+            if customer_id in self._pending:
+                return False
+            self._pending.add(customer_id)
+        self._queue.put(customer_id)
+        return True
+
+    def pending(self):
+        '''
+        return the number of queued and being pushed customers
+        '''
+        return len(self._pending)
+
+    def _work(self):
+        while True:
+            customer_id = self._queue.get()
+            requeue = False
+            try:
+                result = self._push_func(customer_id)
+            except:
+                if self._exc_callback:
+                    self._exc_callback(customer_id, sys.exc_info())
+            else:
+                if self._callback:
+                    self._callback(customer_id, result)
+                try:
+                    requeue = self._requeue is not None and \
+                        self._requeue(customer_id, result)
+                except:
+                    if self._exc_callback:
+                        self._exc_callback(customer_id, sys.exc_info())
+            if requeue:
+                # keep it pending, other customers are ahead of it now
+                self._queue.put(customer_id)
+            else:
+                with self._lock:
+                    self._pending.discard(customer_id)
+
+
+if __name__ == "__main__":
+
+    import time
+
+    slices = {"big": 5}
+    order = []
+
+    def push(customer_id):
+        order.append(customer_id)
+        time.sleep(0.05)
+        if customer_id == "big":
+            slices["big"] -= 1
+            return slices["big"]
+        return 1
+
+    scheduler = PushScheduler(push, 1,
+                              requeue=lambda cid, result: cid == "big" and result > 0)
+    scheduler.start()
+    assert scheduler.submit("big")
+    assert not scheduler.submit("big")
+    for i in range(3):
+        assert scheduler.submit(i)
+    time.sleep(1)
+    # the big customer is pushed slice by slice, others do not wait for it
+    assert order == ["big", "0", "1", "2", "big", "big", "big", "big"]
+    assert scheduler.pending() == 0
+    print "test_ok"
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+segment files of spilled push datas.
+A segment is written once and read by memory map, every record is a
+4 bytes big endian length followed by the data. Records are read from an
+offset, so a segment is drained record by record without being rewritten.
+'''
+
+import os
+import mmap
+import struct
+
+HEADER = struct.Struct(">I")
+
+
+class SegmentError(Exception):
+    pass
+
+
+def write_segment(path, datas):
+    '''
+    write datas to a new segment file atomically, return the file size
+    '''
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for data in datas:
+            f.write(HEADER.pack(len(data)))
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        size = f.tell()
+    os.rename(tmp_path, path)
+    return size
+
+
+def read_segment(path, offset=0, count=None):
+    '''
+    read at most count records from offset, all records if count is None
+    return (records, next offset)
+    '''
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= offset:
+            return [], offset
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        records = []
+        while offset < len(mm) and (count is None or len(records) < count):
+            if offset + HEADER.size > len(mm):
+                raise SegmentError("truncated segment {}".format(path))
+            size, = HEADER.unpack_from(mm, offset)
+            offset += HEADER.size
+            if offset + size > len(mm):
+                raise SegmentError("truncated segment {}".format(path))
+            records.append(mm[offset:offset + size])
+            offset += size
+        return records, offset
+    finally:
+        mm.close()
+
+
+if __name__ == "__main__":
+
+    import tempfile
+    import shutil
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "1", "0.seg")
+        datas = ["data{}".format(i) for i in range(10)] + ["", "x" * 70000]
+        assert write_segment(path, datas) == \
+            sum(len(data) + HEADER.size for data in datas)
+        assert not os.path.exists(path + ".tmp")
+        records, offset = read_segment(path, 0, 4)
+        assert records == datas[:4]
+        records, offset = read_segment(path, offset)
+        assert records == datas[4:]
+        assert read_segment(path, offset) == ([], offset)
+        with open(path, "r+b") as f:
+            f.truncate(offset - 1)
+        try:
+            read_segment(path)
+        except SegmentError:
+            pass
+        else:
+            assert False
+    finally:
+        shutil.rmtree(tmp_dir)
+    print "test_ok"
@@ -7,6 +7,9 @@ import sys
 import os
 from os.path import abspath, join, dirname
 PUSHER_FOLDER = abspath(join(dirname(__file__), os.pardir))
+import time
+import signal
+import threading
 import traceback
 
 sys.path.append(join(PUSHER_FOLDER, 'lib'))
@@ -14,20 +17,45 @@ sys.path.append(join(PUSHER_FOLDER, 'etc'))
 
 import pusher_config as config
 from rdao import Rdao, RdaoException
-from pusher_utils import generate_push_url, push2customer, PushError
+from pusher_utils import generate_push_url, push2customer, PushError, \
+    configure_sessions, configure_gzip, pack_batch, data_size
 from mwampq import Amqp
 from mwlogger import MwLogger
+from breaker import CircuitBreaker
 
 LOG_LEVEL      = config.log_level
 REDIS_URL      = config.redis_url
 PUSH_TIMEOUT   = config.push_timeout
+PREFETCH       = config.pusher_prefetch
+WORKERS        = config.pusher_workers
+ACK_BATCH      = config.pusher_ack_batch
+ACK_INTERVAL   = config.pusher_ack_interval
+METRICS_INTERVAL = config.metrics_interval
 MQ_URL         = config.push_queue['url']
 MQ_EXCHANGE    = config.push_queue['exchange']
 MQ_QUEUE       = config.push_queue['queue']
 MQ_ROUTING_KEY = config.push_queue['routing_key']
 
 logger         = MwLogger('mwPusher', "syslog", log_level=LOG_LEVEL)
-dao            = Rdao(REDIS_URL)
+dao            = Rdao(REDIS_URL, info_cache_size=config.info_cache_size,
+                      info_cache_ttl=config.info_cache_ttl)
+dao.watch_reachable(config.reachable_cache_ttl, config.reachable_fallback_ttl)
+if config.counter_max_pending > 0:
+    dao.aggregate_counters(config.counter_flush_interval,
+                           config.counter_max_pending)
+if config.repusher_spill_dir:
+    dao.mark_spill(config.repusher_spill_threshold)
+
+configure_sessions(**config.http_pool)
+configure_gzip(config.gzip_threshold)
+latency        = dao.track_latency(PUSH_TIMEOUT, **config.latency_timeout)
+
+
+def log_breaker(customer_id, old_state, new_state):
+    logger.info("customer:{} circuit breaker {} -> {}".format(
+        customer_id, old_state, new_state))
+
+breaker        = CircuitBreaker(on_change=log_breaker, **config.circuit_breaker)
 
 
 class SavePushDataException(Exception): pass
@@ -43,27 +71,128 @@ def save_push_data(body, dao):
     unreachable task will save to redis, if save failure, return to rabbitmq
     '''
     try:
-        dao.save_push_data(body['customer_id'], body['push_data'])
+        dao.finish_push(body['customer_id'], body['push_data'], False)
     except:
         raise SavePushDataException(traceback.format_exc())
 
 def save_customer_info(body, dao, customer_info):
     dao_able = True
     reach_able = True
+    options = None
     try:
-        dao.set_customer_info(body['customer_id'], customer_info)
-        reach_able = dao.reachable(body['customer_id'])
+        # set customer info and increase required push count
+        reach_able, options = dao.ingest(body['customer_id'], customer_info)
     except RdaoException:
         dao_able = False
-    return dao_able, reach_able
+    return dao_able, reach_able, options
 
-def push(body, dao):
+def push(body, dao, options=None, data=None):
     '''
-    send date to customer
+    send date to customer, as a json array for batch mode customer.
+    the timeout is adapted to customer's latencies
     '''
     push_addr = generate_push_url(body['push_url'], body['apikey'], \
                                   PUSH_TIMEOUT + 10)
-    push2customer(push_addr, body['push_data'], PUSH_TIMEOUT)
+    if data is None:
+        data = body['push_data']
+        if options and options['batch_size'] > 1:
+            data = pack_batch([data])
+    start = time.time()
+    try:
+        push2customer(push_addr, data, latency.timeout(body['customer_id']),
+                      compress=bool(options and options['gzip']))
+    finally:
+        latency.record(body['customer_id'], time.time() - start)
+
+class Batches(object):
+    '''
+    collect the messages of batch mode customers. A batch is pushed when
+    it is full or it lingered batch_linger milliseconds.
+    Messages are acked by other threads, so it works with workers only.
+    '''
+
+    def __init__(self, push_func, interval=0.01):
+        self._push_func = push_func
+        self._interval = interval
+        # customer_id: [deadline, size, [(body, message)], options]
+        self._batches = {}
+        self._lock = threading.Lock()
+        thr = threading.Thread(target=self._run, name="BatchFlusher")
+        thr.setDaemon(True)
+        thr.start()
+
+    def add(self, body, message, options):
+        customer_id = body['customer_id']
+        length = data_size(body['push_data'])
+        full = None
+        with self._lock:
+            pending = self._batches.get(customer_id)
+            if pending and pending[1] + length > options['batch_bytes']:
+                full = self._batches.pop(customer_id)
+                pending = None
+            if pending is None:
+                deadline = time.time() + options['batch_linger'] / 1000.0
+                pending = self._batches[customer_id] = [deadline, 0, [],
+                                                        options]
+            pending[1] += length
+            pending[2].append((body, message))
+            if len(pending[2]) >= options['batch_size'] or \
+                    pending[1] >= options['batch_bytes']:
+                self._push(self._batches.pop(customer_id))
+        if full:
+            self._push(full)
+
+    def _push(self, pending):
+        thr = threading.Thread(target=self._push_func,
+                               args=(pending[2], pending[3]))
+        thr.setDaemon(True)
+        thr.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            now_ts = time.time()
+            with self._lock:
+                dues = [customer_id for customer_id, pending
+                        in self._batches.items() if pending[0] <= now_ts]
+                for customer_id in dues:
+                    self._push(self._batches.pop(customer_id))
+
+def push_batch(batch, options):
+    '''
+    push a batch of one customer's messages as a json array,
+    save them to redis if pushed failed
+    '''
+    body = batch[-1][0]
+    try:
+        push(body, dao, options,
+             pack_batch([b['push_data'] for b, _ in batch]))
+    except PushError, msg:
+        breaker.failure(body['customer_id'])
+        logger.info('PushError save batch data to redis')
+        for body, message in batch:
+            try:
+                save_push_data(body, dao)
+            except SavePushDataException, msg:
+                message.requeue()
+                logger.error("SavePushDataException: {}".format(msg))
+                logger.event("redis_error", str(msg), errorcode='01150301')
+            else:
+                message.ack()
+    except:
+        for _, message in batch:
+            message.requeue()
+        logger.error("push batch except: {}".format(traceback.format_exc()))
+    else:
+        breaker.success(body['customer_id'])
+        for _, message in batch:
+            message.ack()
+        try:
+            dao.incr_pushed(len(batch))
+        except RdaoException, msg:
+            logger.error("incr_pushed except: {}".format(msg))
+
+batches = Batches(push_batch)
 
 def valid_message(body):
     return 'push_url' in body and 'apikey' in body and \
@@ -82,18 +211,30 @@ def process_task(body, message):
             customer_info['apikey'] = body['apikey']
             logger.info('set_customer_info, id:%s, push_url:%s, apikey:%s'%\
                         (body['customer_id'], body['push_url'], body['apikey']))
-            dao_able, reach_able = save_customer_info(body, dao, customer_info)
+            dao_able, reach_able, options = save_customer_info(body, dao,
+                                                               customer_info)
             if dao_able:
-                dao.incr_required_push()
-                if reach_able:
+                if reach_able and not breaker.allow(body['customer_id']):
+                    logger.info('circuit breaker open save push data to redis')
+                    save_push_data(body, dao)
+                elif reach_able and WORKERS > 0 and options['batch_size'] > 1 \
+                        and options['batch_linger'] > 0:
+                    logger.info('add to batch')
+                    # acked when the batch is pushed
+                    batches.add(body, message, options)
+                    return
+                elif reach_able:
                     logger.info('push to customer')
                     try:
-                        push(body, dao)
+                        push(body, dao, options)
                     except PushError, msg:
+                        breaker.failure(body['customer_id'])
                         logger.info('PushError save push data to redis')
-                        save_push_data(body, dao)    
-                    else:            
-                        dao.incr_pushed()
+                        save_push_data(body, dao)
+                    else:
+                        breaker.success(body['customer_id'])
+                        dao.finish_push(body['customer_id'],
+                                        body['push_data'], True)
                 else:
                     logger.info('reach_unable save push data to redis')
                     save_push_data(body, dao)
@@ -112,11 +253,25 @@ def process_task(body, message):
         logger.warn('receive invalid queue info: {}'.format(body))
         message.ack()
 
+def report_metrics():
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        logger.info("metrics: breaker {}, info_cache {}".format(
+            breaker.stats(), dao.info_cache_stats()))
+
 def main():
+    # exit by SystemExit for flushing the counters
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    metrics_thr = threading.Thread(target=report_metrics, name="Metrics")
+    metrics_thr.setDaemon(True)
+    metrics_thr.start()
     try:
         logger.info('mwPusher start')
         with Amqp(MQ_URL, MQ_EXCHANGE, MQ_QUEUE, MQ_ROUTING_KEY) as q:
-            q.poll(process_task)
+            q.poll(process_task, prefetch_count=PREFETCH, workers=WORKERS,
+                   ack_batch=ACK_BATCH, ack_interval=ACK_INTERVAL)
+    except SystemExit:
+        logger.info('mwPusher stop')
     except:
         logger.error("pusher_unhandle_except: {}".format(traceback.format_exc()))
         logger.event("unhandler_error", traceback.format_exc(), errorcode='01159900')
@@ -3,11 +3,6 @@
 
 import os
 import sys
-import time
-import threadpool
-import threading
-from threading import Event
-import traceback
 
 bin_path = os.path.dirname(os.path.abspath(__file__))
 app_path = os.path.dirname(bin_path)
@@ -19,17 +14,48 @@ sys.path.append(lib_path)
 sys.path.append(etc_path)
 
 import pusher_config as config
+
+# gevent must patch the modules before they are imported
+ENGINE = config.repusher_engine
+if ENGINE == "gevent":
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        ENGINE = "threadpool"
+
+import time
+import signal
+import socket
+import threading
+from threading import Event
+import traceback
+
 from mwlogger import MwLogger
 from rdao import Rdao, RdaoException
+from pusher_utils import PushError
+from pusher_utils import configure_sessions, configure_gzip
+from breaker import CircuitBreaker
+from scheduler import PushScheduler
+from hashring import HashRing
 
 
 PUSH_TIMEOUT = config.push_timeout
 POOLSIZE = config.repusher_threadpool
+GEVENT_POOLSIZE = config.repusher_gevent_pool
 LOOP_INTERVAL = config.repusher_interval
+SLICE_ITEMS = config.repusher_slice_items
+SLICE_SECONDS = config.repusher_slice_seconds
+DUE_BATCH = config.repusher_due_batch
+SHARD = config.repusher_shard
+NODE_EXPIRE = config.repusher_node_expire
+LOCK_EXPIRE = config.repusher_lock_expire
+SPILL_INTERVAL = config.repusher_spill_interval
 REDIS_URL = config.redis_url
 LOG_LEVEL = config.log_level
 
 MODULE = "MWRepusher"
+NODE_ID = "{}:{}".format(socket.gethostname(), os.getpid())
 
 logger = MwLogger(MODULE, "syslog", log_level=LOG_LEVEL)
 
@@ -63,17 +89,98 @@ def master(dao, kev):
             kev.clear()
         time.sleep(5)
 
+def member(dao, kev, ring):
+    '''
+    heartbeat as an alive repusher and keep the ring of alive repushers
+    '''
+    while True:
+        try:
+            nodes = dao.heartbeat(MODULE, NODE_ID, NODE_EXPIRE)
+            if ring.set_nodes(nodes):
+                logger.info("repushers changed: {}".format(nodes))
+            kev.set()
+        except RdaoException as error:
+            logger.error(traceback.format_exc())
+            logger.event("redis_error", str(error), errorcode='01140301')
+            kev.clear()
+        time.sleep(NODE_EXPIRE / 3.0)
+
+def spiller(dao, kev, owns):
+    '''
+    spill the owned customers marked by the pushers
+    '''
+    owner = NODE_ID + "#spill"
+    while True:
+        time.sleep(SPILL_INTERVAL)
+        if not kev.is_set():
+            continue
+        try:
+            for customer_id in dao.get_spill_customers():
+                # locked ones keep marked and are spilled next time
+                if not owns(customer_id) or \
+                        not dao.lock_customer(customer_id, owner, LOCK_EXPIRE):
+                    continue
+                try:
+                    spilled = dao.spill(customer_id, lambda: dao.refresh_lock(
+                        customer_id, owner, LOCK_EXPIRE))
+                finally:
+                    dao.unlock_customer(customer_id, owner)
+                if spilled:
+                    logger.info("customer:{} spilled {} datas".format(
+                        customer_id, spilled))
+        except RdaoException as error:
+            logger.error(traceback.format_exc())
+            logger.event("redis_error", str(error), errorcode='01140301')
+        except:
+            logger.error("spill failed", exc_info=True)
+
 if __name__ == '__main__':
 
+    configure_sessions(**config.http_pool)
+    configure_gzip(config.gzip_threshold)
+
     # master and slaver, impl with redis
-    dao = Rdao(REDIS_URL)
+    def log_breaker(customer_id, old_state, new_state):
+        logger.info("customer:{} circuit breaker {} -> {}".format(
+            customer_id, old_state, new_state))
+
+    def segment_alarm(customer_id, entry):
+        logger.event("segment_unreadable", "customer:{} {}:{}".format(
+            customer_id, entry['host'], entry['path']), errorcode='01140510')
+
+    breaker = CircuitBreaker(on_change=log_breaker, **config.circuit_breaker)
+    dao = Rdao(REDIS_URL, breaker=breaker, drain_chunk=config.repusher_drain_chunk,
+               on_segment_error=segment_alarm)
+    dao.track_latency(PUSH_TIMEOUT, **config.latency_timeout)
+    if config.counter_max_pending > 0:
+        dao.aggregate_counters(config.counter_flush_interval,
+                               config.counter_max_pending)
+    # exit by SystemExit for flushing the counters
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if config.repusher_spill_dir:
+        dao.enable_spill(config.repusher_spill_dir,
+                         config.repusher_spill_threshold,
+                         config.repusher_spill_segment)
     kev = Event()
     kev.clear()
-    master_thr = threading.Thread(target=master, args=(dao, kev))
+    ring = HashRing()
+    if SHARD:
+        master_thr = threading.Thread(target=member, args=(dao, kev, ring))
+    else:
+        master_thr = threading.Thread(target=master, args=(dao, kev))
     master_thr.setDaemon(True)
     master_thr.start()
 
-    logger.info("Kingship thread running......")
+    logger.info("{} thread running......".format(
+        "Member" if SHARD else "Kingship"))
+
+    def owns(customer_id):
+        return not SHARD or ring.get_node(customer_id) == NODE_ID
+
+    if config.repusher_spill_dir:
+        spill_thr = threading.Thread(target=spiller, args=(dao, kev, owns))
+        spill_thr.setDaemon(True)
+        spill_thr.start()
 
     time.sleep(0.5)
 
@@ -94,34 +201,100 @@ if __name__ == '__main__':
 
 
     def do_push(customer_id):
-        return dao.pushall(customer_id, PUSH_TIMEOUT)
+        # the former owner may be pushing it while the ring is changing,
+        # tools/backlog.py locks it while exporting or importing
+        if not dao.lock_customer(customer_id, NODE_ID, LOCK_EXPIRE):
+            dao.schedule(customer_id, int(time.time()) + 1)
+            return 0
+        # a chunk or a segment is done in LOCK_EXPIRE seconds
+        def keepalive():
+            return dao.refresh_lock(customer_id, NODE_ID, LOCK_EXPIRE)
+        try:
+            return dao.pushall(customer_id, PUSH_TIMEOUT, SLICE_ITEMS,
+                               SLICE_SECONDS, keepalive)
+        finally:
+            dao.unlock_customer(customer_id, NODE_ID)
 
-    def log_result(request, result):
-        logger.info("customer:{} push {} results".format(str(request.args[0]), result))
+    def log_result(customer_id, result):
+        logger.info("customer:{} push {} results".format(customer_id, result))
 
-    def exception_alarm(request, exc_info):
-        logger.error("customer:{} push_failed. {}".format(request.args[0], exc_info))
+    def exception_alarm(customer_id, exc_info):
+        logger.error("customer:{} push_failed. {}".format(customer_id, exc_info))
         # send "push_failed" event to monitor
-        logger.event("push_failed", "customer:{} {}".format(request.args[0], exc_info), errorcode='01140509')
+        logger.event("push_failed", "customer:{} {}".format(customer_id, exc_info), errorcode='01140509')
+        if not issubclass(exc_info[0], PushError):
+            # pushall rescheduled it for PushError, retry others next interval
+            try:
+                dao.schedule(customer_id, int(time.time()) + LOOP_INTERVAL)
+            except RdaoException:
+                logger.error(traceback.format_exc())
+
+    def requeue(customer_id, result):
+        # a sliced push keeps the customer due for its rest datas
+        return bool(result) and owns(customer_id) and dao.is_due(customer_id)
+
+    if ENGINE == "gevent":
+        workers = GEVENT_POOLSIZE
+        logger.info("gevent engine running......")
+    else:
+        if config.repusher_engine != ENGINE:
+            logger.info("Ignore gevent engine, gevent is not installed.")
+        workers = POOLSIZE
+    scheduler = PushScheduler(do_push, workers, log_result, exception_alarm, requeue)
+    scheduler.start()
 
-    pool = threadpool.ThreadPool(POOLSIZE)
+    def wait_kingship():
+        # a blocking wait defers SIGTERM until the event is set
+        while not kev.wait(1):
+            pass
 
     try:
+        wait_kingship()
+        # schedule the customers saved by old versions
+        logger.info("rebuild schedule: {} customers scheduled".format(
+            dao.rebuild_schedule()))
+        last_metrics = last_fetch = time.time()
+        woke = True
         while True:
-            kev.wait()
-            customers = dao.get_all_customers()
-            logger.debug("customers is {}".format(str(customers)))
-            requests = threadpool.makeRequests(do_push, customers, log_result, exception_alarm)
-            for req in requests:
-                pool.putRequest(req)
-            pool.wait()
-            time.sleep(LOOP_INTERVAL)
+            wait_kingship()
+            pending = scheduler.pending()
+            if time.time() - last_metrics >= LOOP_INTERVAL:
+                last_metrics = time.time()
+                logger.info("metrics: pending {} breaker {}".format(
+                    pending, breaker.stats()))
+            # due customers being pushed are requeued by the workers,
+            # read the others when they may be pushed now
+            if woke or pending < workers or \
+                    time.time() - last_fetch >= LOOP_INTERVAL:
+                # customers being pushed are the earliest due mostly
+                limit = (pending + DUE_BATCH) * max(len(ring.nodes()), 1)
+                customers = [c for c in dao.get_due_customers(limit=limit)
+                             if owns(c)]
+                logger.debug("due customers is {}".format(str(customers)))
+                last_fetch = time.time()
+                woke = False
+                if len([c for c in customers if scheduler.submit(c)]):
+                    continue
+            # wait for new scheduled customers or the earliest due one
+            next_due_ts = dao.next_due_ts()
+            timeout = LOOP_INTERVAL if next_due_ts is None else \
+                min(LOOP_INTERVAL, next_due_ts - time.time())
+            woke = dao.wait_for_schedule(max(timeout, 1))
 
         if dbpc_thr:
             dbpc_thr.join()
         master_thr.join()
+    except SystemExit:
+        logger.info("Repusher stopped......")
     except:
         error_trace = traceback.format_exc()
         logger.error("I catch unknown error, exit!", exc_info=True)
         logger.event("repush_exception", error_trace, errorcode='01149900')
+    finally:
+        if SHARD:
+            # hand over the customers now
+            try:
+                dao.leave(MODULE, NODE_ID)
+            except RdaoException:
+                pass
 
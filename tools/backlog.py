@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+export and import a customer's push data chunk by chunk, an interrupted
+export or import is resumed by running it again. The customer is locked
+and unscheduled meanwhile, the repushers push it again after it is done.
+An interrupted export keeps the customer locked for LOCK_EXPIRE seconds,
+the exported datas are still the oldest ones when it is resumed in time,
+otherwise it is restarted.
+The spilled segments are exported from their paths, so it runs on the
+host of repusher_spill_dir.
+
+Usage:
+  backlog.py export <customer_id> <file> [--redis=URL] [--chunk=N] [--compress] [--remove]
+  backlog.py import <customer_id> <file> [--redis=URL]
+  backlog.py (--help)
+
+Options:
+  -h --help         show this help message and exit
+  --redis URL       redis url, redis_url of etc/pusher_config.py by default
+  --chunk N         datas read from redis at once [default: 1000]
+  --compress        compress the exported file by zlib
+  --remove          remove the exported datas and segments after exported
+'''
+
+import os
+import sys
+import socket
+
+tools_dir = os.path.dirname(os.path.abspath(__file__))
+base_dir = os.path.dirname(tools_dir)
+sys.path.append(os.path.join(base_dir, "lib"))
+sys.path.append(os.path.join(base_dir, "etc"))
+
+from docopt import docopt
+from rdao import Rdao
+
+# seconds, the lock is refreshed after every chunk
+LOCK_EXPIRE = 3600
+
+
+def report(done, total):
+    sys.stderr.write("\r{}/{}".format(done, total))
+    sys.stderr.flush()
+
+
+def main():
+    args = docopt(__doc__)
+    redis_url = args['--redis']
+    if redis_url is None:
+        import pusher_config
+        redis_url = pusher_config.redis_url
+    dao = Rdao(redis_url)
+    customer_id, path = args['<customer_id>'], args['<file>']
+    # the same owner for the runs resuming an export
+    owner = "backlog:{}:{}".format(socket.gethostname(), os.path.abspath(path))
+    progress_file = path + ".progress"
+
+    if not dao.refresh_lock(customer_id, owner, LOCK_EXPIRE):
+        if not dao.lock_customer(customer_id, owner, LOCK_EXPIRE):
+            sys.exit("customer {} is being pushed, try again later".format(
+                customer_id))
+        if args['export'] and os.path.exists(progress_file):
+            # the exported datas may be pushed since it was interrupted
+            sys.stderr.write("the lock expired, restart the export\n")
+            os.remove(progress_file)
+
+    def locked_report(done, total):
+        if not dao.refresh_lock(customer_id, owner, LOCK_EXPIRE):
+            sys.exit("\nlost the lock of customer {}, run it again".format(
+                customer_id))
+        report(done, total)
+
+    try:
+        dao.unschedule(customer_id)
+        if args['export']:
+            exported = dao.export_push_data(customer_id, path,
+                                            chunk=int(args['--chunk']),
+                                            compress=args['--compress'],
+                                            progress=locked_report)
+            if args['--remove']:
+                # newer datas saved while exporting are kept
+                dao.remove_backlog(customer_id, exported)
+            print "\nexported {} datas to {}".format(exported, path)
+        else:
+            imported = dao.import_push_data(customer_id, path,
+                                            progress=locked_report)
+            print "\nimported {} datas from {}".format(imported, path)
+    finally:
+        if not args['export'] or not os.path.exists(progress_file):
+            dao.unlock_customer(customer_id, owner)
+            dao.schedule(customer_id)
+        else:
+            sys.stderr.write("\ncustomer {} keeps locked for {} seconds, "
+                             "run it again to resume\n".format(
+                                 customer_id, LOCK_EXPIRE))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+micro-benchmark of Amqp.send serialization and compression modes with
+kombu's in-memory transport, messages/s per core of publishing plus
+consuming push_data envelopes.
+Usage: bench_amqp.py [messages]
+'''
+
+import os
+import sys
+import time
+import socket
+
+tools_dir = os.path.dirname(os.path.abspath(__file__))
+base_dir = os.path.dirname(tools_dir)
+sys.path.append(os.path.join(base_dir, "lib"))
+
+from kombu.serialization import SerializerNotInstalled
+from mwampq import Amqp
+
+
+# (name, serializer, compress_threshold)
+MODES = [
+    ("json+zlib", "json", 0),
+    ("json+adaptive", "json", 1024),
+    ("json", "json", float("inf")),
+    ("msgpack+adaptive", "msgpack", 1024),
+]
+
+SIZES = [200, 2 * 1024, 200 * 1024]
+
+
+def envelope(size):
+    return {
+        "customer_id": "1",
+        "push_url": "http://127.0.0.1:8088/mw/matches",
+        "apikey": "#!@$%^dlf$%@!*",
+        "push_data": '{"task_uuid": "89a9d83kd-2k9akdfgg", "matches": "%s"}'
+                     % ("m" * size),
+    }
+
+
+def bench(serializer, compress_threshold, size, messages):
+    body = envelope(size)
+    with Amqp("memory://", "bench", "bench", "bench", serializer=serializer,
+              compress_threshold=compress_threshold) as q:
+        received = [0]
+
+        def on_message(body, message):
+            received[0] += 1
+            message.ack()
+
+        consumer = q.conn.Consumer(q.queue, callbacks=[on_message])
+        consumer.consume()
+        start = time.clock()
+        for _ in xrange(messages):
+            q.send(body)
+        try:
+            while received[0] < messages:
+                q.conn.drain_events(timeout=1)
+        except socket.timeout:
+            pass
+        cost = time.clock() - start
+        consumer.cancel()
+    return received[0] / cost
+
+
+if __name__ == "__main__":
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    print "{:<18}{}".format("mode", "".join("{:>14}".format(
+        "{}B msg/s".format(size)) for size in SIZES))
+    for name, serializer, compress_threshold in MODES:
+        try:
+            rates = [bench(serializer, compress_threshold, size, messages)
+                     for size in SIZES]
+        except SerializerNotInstalled:
+            print "{:<18}not installed".format(name)
+            continue
+        print "{:<18}{}".format(name, "".join(
+            "{:>14.0f}".format(rate) for rate in rates))
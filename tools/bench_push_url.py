@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+benchmark the cost of generate_push_url per push, with and without
+the access token cache.
+Usage: bench_push_url.py [pushes]
+'''
+
+import os
+import sys
+import timeit
+from hashlib import md5, sha512
+from time import time as now
+
+tools_dir = os.path.dirname(os.path.abspath(__file__))
+base_dir = os.path.dirname(tools_dir)
+sys.path.append(os.path.join(base_dir, "lib"))
+
+import pusher_utils
+
+
+URL = "http://127.0.0.1:8088/mw/matches"
+APIKEY = "#!@$%^dlf$%@!*"
+TIMEOUT = 30
+
+
+def generate_push_url_nocache(url, apikey, invalid_sec):
+    ts = int(now()) + invalid_sec
+    at = md5(sha512("{}{}".format(apikey, ts)).hexdigest()).hexdigest()
+    return "{}?ts={}&at={}".format(url, ts, at)
+
+
+def bench(func, pushes):
+    cost = timeit.timeit(lambda: func(URL, APIKEY, TIMEOUT + 10),
+                         number=pushes)
+    return cost / pushes * 1000000
+
+
+if __name__ == "__main__":
+    pushes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    before = bench(generate_push_url_nocache, pushes)
+    after = bench(pusher_utils.generate_push_url, pushes)
+    print "pushes: {}".format(pushes)
+    print "before: {:.3f} us/push".format(before)
+    print "after:  {:.3f} us/push".format(after)
+    print "speedup: {:.1f}x".format(before / after)
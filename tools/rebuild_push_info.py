@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+rebuild the monthly and total push infos from the daily ones, run it once
+after upgrading from a version without push info rollups.
+Usage: rebuild_push_info.py [redis_url]
+'''
+
+import os
+import sys
+
+tools_dir = os.path.dirname(os.path.abspath(__file__))
+base_dir = os.path.dirname(tools_dir)
+sys.path.append(os.path.join(base_dir, "lib"))
+sys.path.append(os.path.join(base_dir, "etc"))
+
+from rdao import Rdao
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        redis_url = sys.argv[1]
+    else:
+        import pusher_config
+        redis_url = pusher_config.redis_url
+    print "rebuilt from {} daily push infos".format(
+        Rdao(redis_url).rebuild_push_info_rollups())